@@ -1,9 +1,14 @@
 # 设计特征用到的
 from .designFeatures import *
+from .featurePlan import *
 from .dataExplore import *
 from .binningStrategy import *
+from .binningSpec import *
+from .quantileSketch import *
+from .woeStrategy import *
 from .compressStrategy import *
 from .fillnaStrategy import *
+from .dtypeStrategy import *
 # data process init
 # add a new dev
 # git diff
@@ -7,16 +7,68 @@ Created on Sun Nov 15 20:46:16 2020
 
 import numpy as np
 import pandas as pd
-import os, re
+import os, re, threading, json
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
+from dataProcess.featureCache import FeatureCache
+from dataProcess.dtypeStrategy import infer_schema, merge_schema, apply_schema, schema_to_json, schema_from_json
 
 
 
 
 class InputBaseData(object):
-    def __init__(self, featurePath, labelPath, dateStamp):
+    # 宽表用到的各类特征文件的模块
+    quarterPatterns = ["cust_info", "big_event"]
+    vildPattern = "cust_avli"
+    monthPatterns = ["aum", "behavior", "cunkuan"]
+
+    def __init__(self, featurePath, labelPath, dateStamp, joinMode='merge',
+                 n_jobs=1, poolType='thread', maxInFlight=None, cacheDir=None, cacheMaxBytes=None,
+                 dtypeSchema=None, schemaSampleRows=10000):
+        """
+        parameter:
+        ----------
+        featurePath : Str
+            特征文件所在的文件夹
+        labelPath : Str
+            标签文件的路径
+        dateStamp : Str
+            数据回溯的时间戳，格式为"%Y-%m-%d"
+        joinMode : Str, default 'merge'
+            拼接宽表的方式，
+            'merge'：每个特征文件依次left merge到已有的table上；
+            'concat'：所有特征文件先按cust_no建索引，再按标签的cust_no顺序一次性拼接
+        n_jobs : Int, default 1
+            并行读取特征文件的worker数，1为串行读取
+        poolType : Str, default 'thread'
+            并行读取的方式，'thread'为线程池，'process'为进程池
+        maxInFlight : Int, default None
+            同时在读取或等待拼接的文件数上限，用来控制内存峰值，默认等于n_jobs
+        cacheDir : Str, default None
+            解析后特征文件的缓存文件夹，None为不使用缓存
+        cacheMaxBytes : Int, default None
+            缓存总大小的上限，超出时淘汰最近最少使用的缓存
+        dtypeSchema : Dict or Str, default None
+            读取特征文件后压缩dtype用的schema，见dtypeStrategy，
+            列名为特征文件中的原始列名，每月的数据加"_m0/_m1/_m2"后缀前统一转换；
+            'infer'为根据各特征文件的前schemaSampleRows行推断；None为不压缩
+        schemaSampleRows : Int, default 10000
+            推断schema时读取的样本行数
+        """
         self.feature_path = featurePath
         self.label_path = labelPath
         self.dateStamp = dateStamp
+        self.joinMode = joinMode
+        self.n_jobs = n_jobs
+        self.poolType = poolType
+        self.maxInFlight = maxInFlight
+        self.cache = FeatureCache(cacheDir, cacheMaxBytes) if cacheDir is not None else None
+        # 读取单个特征文件的函数，接口同pd.read_csv
+        self.reader = self.cache.read_csv if self.cache is not None else pd.read_csv
+        self.dtypeSchema = dtypeSchema
+        self.schemaSampleRows = schemaSampleRows
+        self.memoryRecords = []
+        self.usecols = None
         self.n_samples = 0
         self.n_features = 0
         self.labelCount = {}
@@ -51,13 +103,34 @@ class InputBaseData(object):
         custvild_df : DataFrame
             追加有效客户数据的df
         """
-        for file in self.featureFiles:
-            if re.search(pattern, file):
-                custdf = pd.read_csv(self.feature_path + "/" + file)
-        custdf['vaild_cust'] = True
+        custdf = self.loadVildInfo(pattern)
+        if custdf is None:
+            return df
         custvild_df = df.merge(custdf, how='left', on='cust_no')
         return custvild_df
 
+    def loadVildInfo(self, pattern):
+        """
+        读取有效客户数据，并打上有效客户的标记
+        parameter:
+        ----------
+        pattern : Str
+            符合有效客户的模块
+
+        return:
+        ---------
+        custdf : DataFrame
+            有效客户数据，没有符合的文件或run指定的usecols不需要该文件时为None
+        """
+        # 多个文件符合时，以最后一个为准
+        files = self.matchFiles(pattern)[-1:]
+        usecolsList = [self.projectColumns(file, 'vild') for file in files]
+        if usecolsList in ([], [[]]):
+            return None
+        custdf, = self.readFeatureFiles(files, usecolsList)
+        custdf['vaild_cust'] = True
+        return custdf
+
     def inputQuarterInfo(self, df, pattern):
         """
         输入每季度的信息，不用按月切片
@@ -73,12 +146,33 @@ class InputBaseData(object):
         custinfo_df : DataFrame
             追加信息后的df
         """
-        for file in self.featureFiles:
-            if re.search(pattern, file):
-                custdf = pd.read_csv(self.feature_path + "/" + file)
+        custdf = self.loadQuarterInfo(pattern)
+        if custdf is None:
+            return df
         custinfo_df = df.merge(custdf, how='left', on='cust_no')
         return custinfo_df
 
+    def loadQuarterInfo(self, pattern):
+        """
+        读取每季度的信息
+        parameter:
+        ----------
+        pattern : Str
+            符合客户信息的模块
+
+        return:
+        ----------
+        custdf : DataFrame
+            季度信息数据，没有符合的文件或run指定的usecols不需要该文件时为None
+        """
+        # 多个文件符合时，以最后一个为准
+        files = self.matchFiles(pattern)[-1:]
+        usecolsList = [self.projectColumns(file, 'quarter') for file in files]
+        if usecolsList in ([], [[]]):
+            return None
+        custdf, = self.readFeatureFiles(files, usecolsList)
+        return custdf
+
     def inputMonthInfo(self, df, pattern):
         """
         输入每月的数据，按月切片输入数据
@@ -94,47 +188,226 @@ class InputBaseData(object):
         custother_df : DataFrame
             追加客户AUM数据的df
         """
-        #判断列表中的字符串是否在目标字符串中
-        #def isinList(targetList, targetString):
-        #    for i in targetList:
-        #        if targetString.__contains__(i):
-        #            return True
-        #    else:
-        #        return False
-
         custother_df = df.copy()
-        for file in self.featureFiles:
-            if re.search(pattern, file):
-                fileName, ext = file.split(".")
-                otherdf = pd.read_csv(self.feature_path + "/" + file)
-                #print(self.feature_path + "/" + file)
-                colsName = list(otherdf.columns)
-                colsName.remove("cust_no")
-                if fileName.split("_")[1] in ['m1', 'm4', 'm7', 'm10']:
-                    fileExt = 'm2'
-                elif fileName.split("_")[1] in ['m2', 'm5', 'm8', 'm11']:
-                    fileExt = 'm1'
-                elif fileName.split("_")[1] in ['m3', 'm6', 'm9', 'm12']:
-                    fileExt = 'm0'
-                else:
-                    pass
-                #if isinList(['m1', 'm4', 'm7', 'm10'], fileName):
-                #    fileExt = 'm2'
-                #elif isinList(['m2', 'm5', 'm8', 'm11'], fileName):
-                #    fileExt = 'm1'
-                #elif isinList(['m3', 'm6', 'm9', 'm12'], fileName):
-                #    fileExt = 'm0'
-                #else:
-                #    pass
-                newColsName = [i+"_"+fileExt for i in colsName]
-                renameDict = dict([(i, j) for i, j in zip(colsName, newColsName)])
-                otherdf.rename(renameDict, axis=1, inplace=True)
-                custother_df = custother_df.merge(otherdf, how='left', on='cust_no')
+        for otherdf in self.loadMonthInfo(pattern):
+            custother_df = custother_df.merge(otherdf, how='left', on='cust_no')
         return custother_df
 
-    def run(self):
+    def loadMonthInfo(self, pattern):
+        """
+        读取每月的数据，并按季度内的月份给特征加上"_m0/_m1/_m2"的后缀
+        parameter:
+        ----------
+        pattern : Str
+            符合AUM数据的模块
+
+        return:
+        ----------
+        generator of DataFrame
+            按文件顺序返回的每月数据，依次取用时内存中只保留maxInFlight个待拼接的文件
+        """
+        files = []
+        usecolsList = []
+        for file in self.matchFiles(pattern):
+            usecols = self.projectColumns(file, 'month')
+            # 不包含所需特征的文件直接跳过
+            if usecols != []:
+                files.append(file)
+                usecolsList.append(usecols)
+        for file, otherdf in zip(files, self.readFeatureFiles(files, usecolsList)):
+            fileName, ext = file.split(".")
+            colsName = list(otherdf.columns)
+            colsName.remove("cust_no")
+            fileExt = self.monthExt(fileName)
+            newColsName = [i+"_"+fileExt for i in colsName]
+            renameDict = dict([(i, j) for i, j in zip(colsName, newColsName)])
+            otherdf.rename(renameDict, axis=1, inplace=True)
+            yield otherdf
+
+    def matchFiles(self, pattern):
+        """
+        按文件夹中的顺序，找出符合模块的特征文件
+        """
+        return [file for file in self.featureFiles if re.search(pattern, file)]
+
+    def projectColumns(self, file, kind):
+        """
+        根据run的usecols（最终宽表中的列名），反推特征文件需要读取的原始列。
+        每月的数据按文件对应的"_m0/_m1/_m2"后缀去掉后缀匹配。
+        parameter:
+        ----------
+        file : Str
+            特征文件夹下的文件名
+        kind : Str
+            文件的类型，'quarter'、'vild'或'month'
+
+        return:
+        ----------
+        usecols : List[Str] or None
+            需要读取的列（包含cust_no），None为全部读取，空列表为不需要读取该文件
+        """
+        if self.usecols is None:
+            return None
+        header = pd.read_csv(self.feature_path + "/" + file, nrows=0).columns
+        if kind == 'month':
+            suffix = "_" + str(self.monthExt(file.split(".")[0]))
+            wanted = set(i[:-len(suffix)] for i in self.usecols if i.endswith(suffix))
+        else:
+            wanted = set(self.usecols)
+        colsName = [i for i in header if i != 'cust_no' and i in wanted]
+        if colsName or (kind == 'vild' and 'vaild_cust' in wanted):
+            return ['cust_no'] + colsName
+        return []
+
+    def readFeatureFiles(self, files, usecolsList=None):
+        """
+        读取特征文件，n_jobs大于1时用线程池或进程池并行读取。
+        结果按files的顺序依次返回，同时在读取和等待取走的文件不超过maxInFlight个。
+        parameter:
+        ----------
+        files : List[Str]
+            特征文件夹下的文件名
+        usecolsList : List[List[Str]], default None
+            和files一一对应，每个文件需要读取的列，None为全部读取
+
+        return:
+        ----------
+        generator of DataFrame
+            按files顺序返回的数据
+        """
+        paths = [self.feature_path + "/" + file for file in files]
+        if usecolsList is None:
+            usecolsList = [None] * len(files)
+        reader = self.reader
+        if self.dtypeSchema == 'infer':
+            self.dtypeSchema = self.inferSchema()
+        if self.n_jobs <= 1 or len(paths) <= 1:
+            for file, path, usecols in zip(files, paths, usecolsList):
+                yield self.__record(file, readFeatureFile(path, reader, self.dtypeSchema, usecols))
+            return
+        maxInFlight = self.maxInFlight or self.n_jobs
+        Executor = ProcessPoolExecutor if self.poolType == 'process' else ThreadPoolExecutor
+        with Executor(max_workers=self.n_jobs) as pool:
+            futures = deque()
+            for file, path, usecols in zip(files, paths, usecolsList):
+                if len(futures) >= maxInFlight:
+                    doneFile, future = futures.popleft()
+                    yield self.__record(doneFile, future.result())
+                futures.append((file, pool.submit(readFeatureFile, path, reader, self.dtypeSchema, usecols)))
+            while futures:
+                doneFile, future = futures.popleft()
+                yield self.__record(doneFile, future.result())
+
+    def __record(self, file, result):
+        # 记录压缩dtype前后的内存
+        df, bytesBefore, bytesAfter = result
+        if bytesBefore is not None:
+            self.memoryRecords.append({'file': file, 'bytes_before': bytesBefore, 'bytes_after': bytesAfter})
+        return df
+
+    def inferSchema(self):
+        """
+        读取每个特征文件的前schemaSampleRows行，推断压缩dtype用的schema
+        """
+        schemaList = []
+        for file in self.sourceFiles():
+            sample = pd.read_csv(self.feature_path + "/" + file, nrows=self.schemaSampleRows)
+            schemaList.append(infer_schema(sample))
+        return merge_schema(schemaList)
+
+    def memoryReport(self):
+        """
+        各特征文件压缩dtype前后的内存（字节），最后一行为合计
+        """
+        report = pd.DataFrame(self.memoryRecords, columns=['file', 'bytes_before', 'bytes_after'])
+        report.loc[len(report)] = ['total', report['bytes_before'].sum(), report['bytes_after'].sum()]
+        report['ratio'] = report['bytes_after'] / report['bytes_before']
+        return report
+
+    @staticmethod
+    def monthExt(fileName):
+        """
+        根据文件名中的月份，判断其在季度中的位置
+        {季度末月:m0, 季度中月:m1, 季度首月:m2}
+        """
+        if fileName.split("_")[1] in ['m1', 'm4', 'm7', 'm10']:
+            fileExt = 'm2'
+        elif fileName.split("_")[1] in ['m2', 'm5', 'm8', 'm11']:
+            fileExt = 'm1'
+        elif fileName.split("_")[1] in ['m3', 'm6', 'm9', 'm12']:
+            fileExt = 'm0'
+        else:
+            fileExt = None
+        return fileExt
+
+    @staticmethod
+    def joinSources(df, sources):
+        """
+        单次拼接多个特征表，效果等同于依次做left merge：
+        每个特征表只按cust_no建一次索引，再按df中cust_no的顺序对齐后一次性concat。
+        若特征表的cust_no有重复，或特征名和已有的列重复（merge会加_x/_y后缀），
+        则退回依次merge的方式，保证结果一致。
+        parameter:
+        ----------
+        df : DataFrame
+            已有的table，包含"cust_no"
+        sources : List[DataFrame]
+            需要拼接的特征表，都包含"cust_no"
+
+        return:
+        ----------
+        join_df : DataFrame
+            拼接后的df
+        """
+        usedCols = set(df.columns)
+        singlePass = True
+        for custdf in sources:
+            colsName = [i for i in custdf.columns if i != 'cust_no']
+            if (not custdf['cust_no'].is_unique) or usedCols.intersection(colsName):
+                singlePass = False
+                break
+            usedCols.update(colsName)
+        if not singlePass:
+            join_df = df
+            for custdf in sources:
+                join_df = join_df.merge(custdf, how='left', on='cust_no')
+            return join_df
+        keys = pd.Index(df['cust_no'])
+        blocks = [df.reset_index(drop=True)]
+        for custdf in sources:
+            aligned = custdf.set_index('cust_no').reindex(keys)
+            blocks.append(aligned.reset_index(drop=True))
+        join_df = pd.concat(blocks, axis=1)
+        return join_df
+
+    def run(self, usecols=None):
+        """
+        拼接宽表，结果保存在self.baseData
+        parameter:
+        ----------
+        usecols : List[Str], default None
+            只需要的宽表列名，如"balance_m0"，只读取这些列对应的原始列，
+            不包含所需列的特征文件不再读取；None为读取全部列。标签文件总是全部读取
+        """
+        self.usecols = usecols
         # 0 导入标签数据
         baseData = self.inputLabel()
+        if self.joinMode == 'concat':
+            # 1~6 读取所有特征表后一次性拼接
+            sources = [self.loadQuarterInfo(pattern) for pattern in self.quarterPatterns]
+            sources.append(self.loadVildInfo(self.vildPattern))
+            sources = [custdf for custdf in sources if custdf is not None]
+            for pattern in self.monthPatterns:
+                sources.extend(self.loadMonthInfo(pattern))
+            baseData = self.joinSources(baseData, sources)
+        else:
+            baseData = self.runMerge(baseData)
+        # 7导入数据回溯时间戳
+        baseData['dataStamp'] = pd.to_datetime(pd.Series([self.dateStamp+" 23:59:59"]*baseData.shape[0]), format="%Y-%m-%d %H:%M:%S")
+        self.baseData = baseData
+        return
+
+    def runMerge(self, baseData):
         # 1 导入客户信息数据
         baseData = self.inputQuarterInfo(baseData, "cust_info")
         # 2 导入客户重大事件数据
@@ -147,11 +420,502 @@ class InputBaseData(object):
         baseData = self.inputMonthInfo(baseData, "behavior")
         # 6 导入cunkuan数据
         baseData = self.inputMonthInfo(baseData, "cunkuan")
-        # 7导入数据回溯时间戳
-        baseData['dataStamp'] = pd.to_datetime(pd.Series([self.dateStamp+" 23:59:59"]*baseData.shape[0]), format="%Y-%m-%d %H:%M:%S")
+        return baseData
+
+    def sourceFiles(self, projected=True):
+        """
+        run中实际会读取的特征文件，按文件夹中的顺序排列
+        parameter:
+        ----------
+        projected : Bool, default True
+            是否去掉按usecols不需要读取的文件，False时返回run匹配到的全部特征文件
+        """
+        usedFiles = set()
+        for kind, patterns in [('quarter', self.quarterPatterns), ('vild', [self.vildPattern]), ('month', self.monthPatterns)]:
+            for pattern in patterns:
+                matched = self.matchFiles(pattern) if kind == 'month' else self.matchFiles(pattern)[-1:]
+                usedFiles.update(file for file in matched if not projected or self.projectColumns(file, kind) != [])
+        return [file for file in self.featureFiles if file in usedFiles]
+
+    def partitionInputs(self, shardDir, nShards, chunksize=100000):
+        """
+        流式切分输入数据：按块读取标签和特征文件，按cust_no的哈希值分到nShards个分片，
+        每个分片的目录为shardDir/part-xxxxx，其中label.csv为标签，features/下为同名的特征文件。
+        cust_no一律按字符串读取，并规范化（去掉首尾空格和"123.0"这样的小数部分）后再哈希，
+        同一客户在所有文件、所有数据块中都落在同一个分片，不受各文件dtype推断的影响。
+        parameter:
+        ----------
+        shardDir : Str
+            分片的存放目录
+        nShards : Int
+            分片个数
+        chunksize : Int, default 100000
+            每次读取的行数
+
+        return:
+        ----------
+        partDirs : List[Str]
+            各分片的目录
+        """
+        partDirs = [os.path.join(shardDir, "part-%05d" % k) for k in range(nShards)]
+        for partDir in partDirs:
+            os.makedirs(os.path.join(partDir, "features"), exist_ok=True)
+        inputs = [(self.label_path, "label.csv", None)]
+        for file in self.sourceFiles():
+            # 指定了usecols时，分片中只保留需要的列
+            usecols = None
+            for kind, patterns in [('quarter', self.quarterPatterns), ('vild', [self.vildPattern]), ('month', self.monthPatterns)]:
+                if any(re.search(pattern, file) for pattern in patterns):
+                    usecols = self.projectColumns(file, kind)
+            inputs.append((self.feature_path + "/" + file, os.path.join("features", file), usecols))
+        for path, name, usecols in inputs:
+            # 先给每个分片写上表头，空分片也能读出完整的列
+            header = pd.read_csv(path, nrows=0, usecols=usecols, dtype={'cust_no': str})
+            for partDir in partDirs:
+                header.to_csv(os.path.join(partDir, name), index=False)
+            for chunk in pd.read_csv(path, chunksize=chunksize, usecols=usecols, dtype={'cust_no': str}):
+                shardIdx = shardKeys(chunk['cust_no']) % nShards
+                for k, part in chunk.groupby(shardIdx, sort=False):
+                    part.to_csv(os.path.join(partDirs[k], name), mode='a', header=False, index=False)
+        return partDirs
+
+    def iterPartitions(self, shardDir, nShards, chunksize=100000, usecols=None):
+        """
+        分片模式：先用partitionInputs切分输入数据，再逐个分片拼接宽表，
+        内存中只需要放下一个分片的数据。分片内保持标签文件中的顺序。
+        parameter:
+        ----------
+        shardDir : Str
+            分片的存放目录
+        nShards : Int
+            分片个数
+        chunksize : Int, default 100000
+            切分时每次读取的行数
+        usecols : List[Str], default None
+            只需要的宽表列名，同run
+
+        return:
+        ----------
+        generator of DataFrame
+            各分片的宽表
+        """
+        self.usecols = usecols
+        partDirs = self.partitionInputs(shardDir, nShards, chunksize)
+        usedFiles = self.sourceFiles()
+        if self.dtypeSchema == 'infer':
+            # 所有分片用同一份schema，各分片的dtype才一致
+            self.dtypeSchema = self.inferSchema()
+        self.labelCount = {}
+        for partDir in partDirs:
+            shard = InputBaseData(os.path.join(partDir, "features"), os.path.join(partDir, "label.csv"),
+                                  self.dateStamp, joinMode=self.joinMode, n_jobs=self.n_jobs,
+                                  poolType=self.poolType, maxInFlight=self.maxInFlight,
+                                  dtypeSchema=self.dtypeSchema)
+            # 保持和原文件夹一样的文件顺序，列的顺序才一致
+            shard.featureFiles = usedFiles
+            shard.run(usecols)
+            for k, v in shard.labelCount.items():
+                self.labelCount[k] = self.labelCount.get(k, 0) + v
+            self.memoryRecords.extend(shard.memoryRecords)
+            yield shard.baseData
+
+    def runPartitioned(self, shardDir, nShards, outputDir, chunksize=100000, usecols=None):
+        """
+        分片模式，把各分片的宽表写到outputDir/part-xxxxx.pkl
+        parameter:
+        ----------
+        shardDir : Str
+            分片的存放目录
+        nShards : Int
+            分片个数
+        outputDir : Str
+            宽表分片的输出目录
+        chunksize : Int, default 100000
+            切分时每次读取的行数
+        usecols : List[Str], default None
+            只需要的宽表列名，同run
+
+        return:
+        ----------
+        outputFiles : List[Str]
+            各分片宽表的路径
+        """
+        os.makedirs(outputDir, exist_ok=True)
+        outputFiles = []
+        for k, shardData in enumerate(self.iterPartitions(shardDir, nShards, chunksize, usecols)):
+            outputFile = os.path.join(outputDir, "part-%05d.pkl" % k)
+            shardData.to_pickle(outputFile)
+            outputFiles.append(outputFile)
+        return outputFiles
+
+class SharedSourceReader(object):
+    """
+    多个InputBaseData共用的读取器，同一个文件（读取的列也相同）只解析一次，
+    之后返回共享数据的浅拷贝，改列名、加列都不会影响其他使用者。
+    useCounts记录每个文件还会被读取的次数，减到0时释放该文件。
+    解析后的数据只在本进程内共享，使用者需要用线程池读取文件。
+    """
+    def __init__(self, reader=pd.read_csv, useCounts=None):
+        self.reader = reader
+        self.useCounts = dict((os.path.abspath(k), v) for k, v in (useCounts or {}).items())
+        self.frames = {}
+        self.parseCount = 0
+        self.__lock = threading.Lock()
+        self.__keyLocks = {}
+
+    def __call__(self, path, **kwargs):
+        path = os.path.abspath(path)
+        key = (path, repr(sorted(kwargs.items())))
+        with self.__lock:
+            keyLock = self.__keyLocks.setdefault(key, threading.Lock())
+        with keyLock:
+            if key not in self.frames:
+                self.frames[key] = self.reader(path, **kwargs)
+                self.parseCount += 1
+            df = self.frames[key]
+        with self.__lock:
+            if path in self.useCounts:
+                self.useCounts[path] -= 1
+                if self.useCounts[path] <= 0:
+                    for k in [k for k in self.frames if k[0] == path]:
+                        self.frames.pop(k)
+        return df.copy(deep=False)
+
+
+class BacktestBaseData(object):
+    def __init__(self, snapshots, n_jobs=1, **kwargs):
+        """
+        回溯用的多期宽表，多期共用的特征文件只解析一次
+        parameter:
+        ----------
+        snapshots : List[Tuple]
+            每期的(featurePath, labelPath, dateStamp)
+        n_jobs : Int, default 1
+            同时拼接的期数，多期用线程并行，共享解析好的特征文件
+        kwargs :
+            传给每期InputBaseData的参数，如joinMode、cacheDir、dtypeSchema，
+            poolType固定为'thread'
+        """
+        self.snapshots = snapshots
+        self.n_jobs = n_jobs
+        kwargs['poolType'] = 'thread'
+        self.inputs = [InputBaseData(featurePath, labelPath, dateStamp, **kwargs)
+                       for featurePath, labelPath, dateStamp in snapshots]
+        self.baseDatas = []
+        self.reader = None
+
+    def run(self, usecols=None):
+        """
+        拼接每期的宽表，结果按snapshots的顺序保存在self.baseDatas
+        parameter:
+        ----------
+        usecols : List[Str], default None
+            只需要的宽表列名，同InputBaseData.run
+        """
+        # 统计每个特征文件被几期用到，全部用完后释放
+        useCounts = {}
+        for inputBD in self.inputs:
+            inputBD.usecols = usecols
+            for file in inputBD.sourceFiles():
+                path = os.path.abspath(inputBD.feature_path + "/" + file)
+                useCounts[path] = useCounts.get(path, 0) + 1
+        self.reader = SharedSourceReader(self.inputs[0].reader if self.inputs else pd.read_csv, useCounts)
+        for inputBD in self.inputs:
+            inputBD.reader = self.reader
+        if self.n_jobs <= 1:
+            for inputBD in self.inputs:
+                inputBD.run(usecols)
+        else:
+            with ThreadPoolExecutor(max_workers=self.n_jobs) as pool:
+                list(pool.map(lambda inputBD: inputBD.run(usecols), self.inputs))
+        self.baseDatas = [inputBD.baseData for inputBD in self.inputs]
+        return
+
+
+class MaterializedBaseData(object):
+    def __init__(self, tableDir, window=3, reader=pd.read_csv):
+        """
+        落盘的宽表，附带清单manifest.json，记录匹配到的每个特征文件（包括按usecols不需要读取的文件），
+        新的月份文件到达时只读取新文件，平移"_m0/_m1/_m2"的后缀，而不用重新拼接全部文件。
+        宽表按来源分列存储：base.pkl为标签等不属于任何特征文件的列，
+        parts/下每个特征文件一个pkl，保存该文件的列（月份文件为不带后缀的原始列名），行顺序和base.pkl一致，
+        后缀只记录在清单里。刷新时只写新增或变化文件的分块和清单，不重写历史数据。
+        移出窗口的月份文件在清单中保留一条expired的记录，文件仍在文件夹中时也不会被当作新的月份；
+        清单还记录run生成的列顺序，load按该顺序拼出宽表。
+        parameter:
+        ----------
+        tableDir : Str
+            宽表和清单的存放目录
+        window : Int, default 3
+            保留的月份个数，后缀为m0~m{window-1}，m0为最近的月份
+        reader : function, default pd.read_csv
+            读取特征文件的函数
+        """
+        self.tableDir = tableDir
+        self.window = window
+        self.reader = reader
+        self.baseData = None
+        self.manifest = {}
+        os.makedirs(os.path.join(tableDir, "parts"), exist_ok=True)
+
+    def build(self, inputBD):
+        """
+        用已经run过的InputBaseData生成宽表和清单并落盘
+        parameter:
+        ----------
+        inputBD : InputBaseData
+            已经执行过run的InputBaseData
+        """
+        self.manifest = {'dateStamp': inputBD.dateStamp,
+                         'dtypeSchema': schema_to_json(inputBD.dtypeSchema) if isinstance(inputBD.dtypeSchema, dict) else None,
+                         'usecols': inputBD.usecols,
+                         'monthPatterns': list(inputBD.monthPatterns),
+                         'nextPart': 0,
+                         'columns': list(inputBD.baseData.columns),
+                         'files': {}}
+        baseData = inputBD.baseData.reset_index(drop=True)
+        fileColumns = set()
+        for file in inputBD.sourceFiles(projected=False):
+            path = os.path.abspath(inputBD.feature_path + "/" + file)
+            kind, family, fileExt = 'quarter', None, None
+            if re.search(inputBD.vildPattern, file):
+                kind = 'vild'
+            for pattern in inputBD.monthPatterns:
+                if re.search(pattern, file):
+                    kind, family, fileExt = 'month', pattern, inputBD.monthExt(file.split(".")[0])
+            rawColumns = self.__header(path) + (['vaild_cust'] if kind == 'vild' else [])
+            # 按usecols没有读取的文件也记进清单，只是没有列
+            rawColumns = [i for i in rawColumns if self.__suffixed(i, fileExt) in baseData.columns]
+            entry = dict(self.__fileStat(path), kind=kind, family=family, ext=fileExt, columns=rawColumns, part=None,
+                         month=_fileMonth(file) if kind == 'month' else None, expired=False)
+            if rawColumns:
+                part = baseData[[self.__suffixed(i, fileExt) for i in rawColumns]]
+                self.__writePart(entry, part.set_axis(rawColumns, axis=1))
+            fileColumns.update(self.__suffixed(i, fileExt) for i in rawColumns)
+            self.manifest['files'][path] = entry
+        base = baseData[[i for i in baseData.columns if i not in fileColumns and i != 'dataStamp']]
+        base.to_pickle(os.path.join(self.tableDir, "base.pkl"))
+        self.__saveManifest()
+        self.baseData = inputBD.baseData
+        return
+
+    def load(self, usecols=None):
+        """
+        按清单拼出宽表，保存在self.baseData
+        parameter:
+        ----------
+        usecols : List[Str], default None
+            只需要的宽表列名，只读取包含这些列的分块；None为按build时的usecols读取，
+            月份平移后超出build时usecols的列不放进宽表
+        """
+        with open(os.path.join(self.tableDir, "manifest.json"), encoding='utf-8') as f:
+            self.manifest = json.load(f)
+        base = pd.read_pickle(os.path.join(self.tableDir, "base.pkl"))
+        blocks = [base]
+        for entry in self.__orderedEntries():
+            colsName = [self.__suffixed(i, entry['ext']) for i in entry['columns']]
+            if usecols is not None:
+                colsName = [i for i in colsName if i in usecols]
+            elif entry['kind'] == 'month' and self.manifest.get('usecols') is not None:
+                # 平移后超出usecols的月份列不再放进宽表
+                colsName = [i for i in colsName if i in self.manifest['usecols']]
+            if not colsName:
+                continue
+            part = pd.read_pickle(os.path.join(self.tableDir, entry['part']))
+            part.columns = [self.__suffixed(i, entry['ext']) for i in part.columns]
+            blocks.append(part[colsName])
+        baseData = pd.concat(blocks, axis=1)
+        baseData['dataStamp'] = pd.to_datetime(pd.Series([self.manifest['dateStamp'] + " 23:59:59"] * baseData.shape[0]),
+                                               format="%Y-%m-%d %H:%M:%S")
+        # 按run生成的列顺序排列，月份平移后列名不变，位置也不变；清单中没有的列放在最后
+        position = dict((colName, i) for i, colName in enumerate(self.manifest.get('columns', [])))
+        order = sorted(range(baseData.shape[1]), key=lambda i: (position.get(baseData.columns[i], len(position)), i))
+        baseData = baseData.iloc[:, order]
         self.baseData = baseData
+        return self.baseData
+
+    def refresh(self, featurePath, dateStamp=None, monthPatterns=None):
+        """
+        增量刷新：
+        1、清单中已有、但大小或修改时间变化的文件，重新读取并替换其对应的分块；
+        2、featurePath下清单中没有的月份文件，按文件名中的月份在该模块当前m0之后的月数（跨年时也是m12在m1之前）
+           从早到晚依次作为新的m0，同一模块原有的m0~m{window-2}后缀依次加1，超出窗口的月份标记为expired，
+           清单中的文件（包括expired的）不会再被当作新文件。
+        只读取、写入新增或变化的文件和清单，耗时和新文件的大小有关，和历史数据的多少无关。
+        刷新后self.baseData置为None，需要宽表时调用load。
+        parameter:
+        ----------
+        featurePath : Str
+            新的特征文件所在的文件夹
+        dateStamp : Str, default None
+            新的数据回溯时间戳，None为不修改
+        monthPatterns : List[Str], default None
+            每月数据的模块，None为build时的模块
+
+        return:
+        ----------
+        changedFiles : List[Str]
+            本次读取的文件
+        """
+        with open(os.path.join(self.tableDir, "manifest.json"), encoding='utf-8') as f:
+            self.manifest = json.load(f)
+        monthPatterns = self.manifest['monthPatterns'] if monthPatterns is None else monthPatterns
+        files = self.manifest['files']
+        keys = None
+        changedFiles = []
+        removedParts = []
+        # 1 变化的文件
+        for path, entry in list(files.items()):
+            if entry.get('expired') or not os.path.exists(path) \
+                    or self.__fileStat(path) == {'size': entry['size'], 'mtime': entry['mtime']}:
+                continue
+            keys = self.__keys() if keys is None else keys
+            removedParts.append(entry['part'])
+            self.__joinFile(path, entry, keys)
+            entry.update(self.__fileStat(path))
+            changedFiles.append(path)
+        # 2 新的月份文件，按在当前m0之后的月数排序，当前m0的月份未知时按修改时间
+        # 各模块m0对应的月份，由未过期的月份文件的月份加上其后缀推出
+        currentMonth = {}
+        for entry in files.values():
+            if entry['kind'] == 'month' and not entry.get('expired') and entry.get('month'):
+                currentMonth[entry['family']] = (entry['month'] + int(entry['ext'][1:]) - 1) % 12 + 1
+        newFiles = []
+        for file in os.listdir(featurePath):
+            path = os.path.abspath(featurePath + "/" + file)
+            family = [pattern for pattern in monthPatterns if re.search(pattern, file)]
+            if path not in files and family:
+                month, lastMonth = _fileMonth(file), currentMonth.get(family[-1])
+                ahead = (month - lastMonth - 1) % 12 + 1 if month and lastMonth else 0
+                newFiles.append((ahead, os.stat(path).st_mtime_ns, path, family[-1], month))
+        for _, _, path, family, month in sorted(newFiles):
+            keys = self.__keys() if keys is None else keys
+            removedParts.extend(self.__shiftMonths(family))
+            entry = dict(self.__fileStat(path), kind='month', family=family, ext='m0', columns=[], part=None,
+                         month=month, expired=False)
+            self.__joinFile(path, entry, keys)
+            files[path] = entry
+            changedFiles.append(path)
+        if dateStamp is not None:
+            self.manifest['dateStamp'] = dateStamp
+        # 先写清单，再删除不再使用的分块
+        self.__saveManifest()
+        for part in removedParts:
+            if part is not None:
+                os.remove(os.path.join(self.tableDir, part))
+        self.baseData = None
+        return changedFiles
+
+    def __shiftMonths(self, family):
+        # 同一模块的月份后缀加1，超出窗口的标记为expired并去掉分块，返回需要删除的分块
+        files = self.manifest['files']
+        removedParts = []
+        for path, entry in list(files.items()):
+            if entry['family'] != family or entry.get('expired'):
+                continue
+            month = int(entry['ext'][1:]) + 1
+            if month >= self.window:
+                removedParts.append(entry['part'])
+                entry.update(expired=True, ext=None, columns=[], part=None)
+                continue
+            entry['ext'] = "m%d" % month
+        return removedParts
+
+    def __joinFile(self, path, entry, keys):
+        # 读取一个文件，按清单中的usecols投影、dtypeSchema压缩后按base.pkl的cust_no对齐，写成新的分块
+        usecols = None
+        fileExt = entry['ext']
+        if self.manifest.get('usecols') is not None:
+            suffixes = ["_m%d" % i for i in range(self.window)] if fileExt else [""]
+            wanted = set()
+            for i in self.manifest['usecols']:
+                wanted.update(i[:-len(j)] if j else i for j in suffixes if i.endswith(j))
+            usecols = ['cust_no'] + [i for i in self.__header(path) if i in wanted]
+            if len(usecols) == 1 and not (entry['kind'] == 'vild' and 'vaild_cust' in wanted):
+                # 不需要该文件的任何列，只记进清单
+                entry['columns'], entry['part'] = [], None
+                return
+        df, _, _ = readFeatureFile(path, self.reader, schema_from_json(self.manifest.get('dtypeSchema')), usecols)
+        if entry['kind'] == 'vild':
+            df['vaild_cust'] = True
+        if not df['cust_no'].is_unique:
+            raise ValueError(f"{path}中的cust_no有重复，无法增量刷新，请重新build")
+        part = df.set_index('cust_no').reindex(keys).reset_index(drop=True)
+        entry['columns'] = list(part.columns)
+        self.__writePart(entry, part)
+        return
+
+    def __writePart(self, entry, part):
+        # 每次写新的文件名，清单写好之前旧的分块仍然有效
+        entry['part'] = "parts/part-%05d.pkl" % self.manifest['nextPart']
+        self.manifest['nextPart'] += 1
+        part.reset_index(drop=True).to_pickle(os.path.join(self.tableDir, entry['part']))
+        return
+
+    def __keys(self):
+        return pd.Index(pd.read_pickle(os.path.join(self.tableDir, "base.pkl"))['cust_no'])
+
+    def __saveManifest(self):
+        tmpPath = os.path.join(self.tableDir, "manifest.json.tmp")
+        with open(tmpPath, 'w', encoding='utf-8') as f:
+            json.dump(self.manifest, f, ensure_ascii=False, indent=1)
+        os.replace(tmpPath, os.path.join(self.tableDir, "manifest.json"))
         return
 
+    def __orderedEntries(self):
+        # 季度、有效客户文件在前，月份文件按模块、由早到晚（m2、m1、m0）排列
+        families = self.manifest['monthPatterns']
+        entries = [entry for entry in self.manifest['files'].values() if not entry.get('expired')]
+        def order(entry):
+            if entry['kind'] != 'month':
+                return (0, 0, 0)
+            return (1, families.index(entry['family']) if entry['family'] in families else len(families), -int(entry['ext'][1:]))
+        return sorted(entries, key=order)
+
+    @staticmethod
+    def __suffixed(colName, fileExt):
+        return colName + "_" + fileExt if fileExt else colName
+
+    @staticmethod
+    def __header(path):
+        return [i for i in pd.read_csv(path, nrows=0).columns if i != 'cust_no']
+
+    @staticmethod
+    def __fileStat(path):
+        stat = os.stat(path)
+        return {'size': stat.st_size, 'mtime': stat.st_mtime_ns}
+
+
+def _fileMonth(fileName):
+    """
+    文件名中的月份，如aum_m10.csv为10，没有月份时为0
+    """
+    month = re.search(r"_m(\d+)", fileName)
+    return int(month.group(1)) if month else 0
+
+
+def shardKeys(custNo):
+    """
+    cust_no规范化为字符串后的哈希值，int、float、字符串形式的同一个cust_no得到同样的哈希值
+    """
+    keys = custNo.astype(str).str.strip().str.replace(r"\.0+$", "", regex=True)
+    return pd.util.hash_array(np.asarray(keys, dtype=object))
+
+
+def readFeatureFile(path, reader=pd.read_csv, dtypeSchema=None, usecols=None):
+    """
+    读取单个特征文件，有schema时压缩dtype，并返回压缩前后的内存（字节）。
+    放在模块层，进程池才能调用。
+    """
+    df = reader(path) if usecols is None else reader(path, usecols=usecols)
+    if dtypeSchema is None:
+        return df, None, None
+    bytesBefore = int(df.memory_usage(index=False, deep=True).sum())
+    # 整数转为浮点数，left join补上的缺失是NaN，和不压缩时一样可以直接比较大小
+    df = apply_schema(df, dtypeSchema, nullable='float')
+    bytesAfter = int(df.memory_usage(index=False, deep=True).sum())
+    return df, bytesBefore, bytesAfter
+
 #%%
         
 if __name__ == "__main__":
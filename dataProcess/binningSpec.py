@@ -0,0 +1,228 @@
+# -*- coding: utf-8 -*-
+"""
+*********************************************************************
+*                          Funtion Table                            *
+*********************************************************************
+*     BinSpec.from_bins()       *      由分箱结果bins生成分箱规则         *
+*********************************************************************
+*     BinSpec.transform()       *      对新数据应用单个特征的分箱规则      *
+*********************************************************************
+*     BinSpecSet.from_bins()    *      由多个特征的bins生成规则集合       *
+*********************************************************************
+*     BinSpecSet.transform()    *      对新数据应用全部分箱规则           *
+*********************************************************************
+*     BinSpecSet.save()/load()  *      规则集合的保存和读取              *
+*********************************************************************
+
+分箱规则有三种：
+    'cut'      : 连续特征或有序离散特征，bins为切分点列表，按(bins[i], bins[i+1]]分到第i箱，
+                 用np.searchsorted分箱，超出训练时范围的值归到两端的箱子，
+                 没有设置fillna时缺失值的编码为-1，不会混进任何一个箱子
+    'map'      : 无序离散特征，bins为字典，字典中没有的值取bins['other']，
+                 用pd.Index.get_indexer查表
+    'identity' : 类别数不超过阈值、没有分箱（bins为None）的特征，原值输出
+"""
+
+import numpy as np
+import pandas as pd
+import json
+from concurrent.futures import ThreadPoolExecutor
+
+__all__ = ['BinSpec', 'BinSpecSet']
+
+
+class BinSpec(object):
+    def __init__(self, colName, kind, edges=None, keys=None, values=None, default=None, fillna=None):
+        """
+        parameter:
+        ----------
+        colName : Str
+            特征名称
+        kind : Str
+            规则类型，'cut'、'map'或'identity'
+        edges : 1D array
+            'cut'的切分点
+        keys : 1D array
+            'map'的原值
+        values : 1D array
+            'map'中原值对应的分箱值
+        default : Object
+            'map'中字典外的值对应的分箱值，即bins['other']，没有时为NaN
+        fillna : Float
+            分箱前用来填补缺失的值，和训练时的填缺值保持一致，None为不填缺
+        """
+        self.colName = colName
+        self.kind = kind
+        self.edges = None if edges is None else np.asarray(edges, dtype=np.float64)
+        self.keys = None if keys is None else np.asarray(keys)
+        self.values = None if values is None else np.asarray(values)
+        if self.values is not None and self.values.dtype.kind not in 'biuf':
+            self.values = self.values.astype(object)
+        self.default = default
+        self.fillna = fillna
+        self.__index = None
+
+    @classmethod
+    def from_bins(cls, colName, bins, fillna=None):
+        """
+        由binning_continuous0、binning_category0返回的bins生成分箱规则
+        """
+        if bins is None:
+            return cls(colName, 'identity', fillna=fillna)
+        if isinstance(bins, dict):
+            bins = dict(bins)
+            default = bins.pop('other', np.nan)
+            keys = np.empty(len(bins), dtype=object)
+            keys[:] = list(bins.keys())
+            return cls(colName, 'map', keys=keys, values=list(bins.values()), default=default, fillna=fillna)
+        return cls(colName, 'cut', edges=[float(i) for i in bins], fillna=fillna)
+
+    def transform(self, Xarray):
+        """
+        对新数据分箱
+
+        parameter:
+        ----------
+        Xarray : 1D array-like
+            特征数据
+
+        return:
+        ----------
+        X_box : 1D array
+            'cut'为箱子编码（缺失为-1），'map'为字典中的分箱值，'identity'为原值
+        """
+        if self.fillna is not None:
+            Xarray = pd.Series(Xarray).fillna(self.fillna).to_numpy()
+        if self.kind == 'identity':
+            return np.asarray(Xarray)
+        if self.kind == 'cut':
+            nBins = len(self.edges) - 1
+            Xarray = np.asarray(Xarray, dtype=np.float64)
+            codes = np.searchsorted(self.edges, Xarray, side='left') - 1
+            np.clip(codes, 0, nBins - 1, out=codes)
+            # searchsorted把NaN排在最后，clip后会落进最高的箱子，单独编码为-1
+            codes[np.isnan(Xarray)] = -1
+            return codes.astype(np.int8 if nBins < 127 else np.int32)
+        if self.__index is None:
+            self.__index = pd.Index(self.keys)
+        idx = self.__index.get_indexer(np.asarray(Xarray))
+        table = np.append(self.values, [self.default])
+        # get_indexer找不到时为-1，正好取到最后的default
+        return table[idx]
+
+    def to_dict(self):
+        """
+        转为可以json序列化的字典
+        """
+        spec = {'colName': self.colName, 'kind': self.kind, 'fillna': _to_python(self.fillna)}
+        if self.kind == 'cut':
+            spec['edges'] = self.edges.tolist()
+        elif self.kind == 'map':
+            spec['keys'] = [_to_python(i) for i in self.keys]
+            spec['values'] = [_to_python(i) for i in self.values]
+            spec['default'] = _to_python(self.default)
+        return spec
+
+    @classmethod
+    def from_dict(cls, spec):
+        keys = None
+        if spec.get('keys') is not None:
+            keys = np.empty(len(spec['keys']), dtype=object)
+            keys[:] = spec['keys']
+        default = spec.get('default')
+        return cls(spec['colName'], spec['kind'], edges=spec.get('edges'), keys=keys, values=spec.get('values'),
+                   default=np.nan if default is None else default, fillna=spec.get('fillna'))
+
+
+class BinSpecSet(object):
+    def __init__(self, specs=None):
+        """
+        parameter:
+        ----------
+        specs : List[BinSpec]
+            各特征的分箱规则
+        """
+        self.specs = dict((spec.colName, spec) for spec in (specs or []))
+
+    @classmethod
+    def from_bins(cls, binsDict, fillna=None):
+        """
+        由{特征名称: bins}生成规则集合，如binning_batch返回的bins
+
+        parameter:
+        ----------
+        binsDict : Dict
+            {特征名称: bins}
+        fillna : Float or Dict, default None
+            分箱前的填缺值，字典时按特征分别指定
+        """
+        specs = []
+        for colName, bins in binsDict.items():
+            value = fillna.get(colName) if isinstance(fillna, dict) else fillna
+            specs.append(BinSpec.from_bins(colName, bins, value))
+        return cls(specs)
+
+    def add(self, spec):
+        self.specs[spec.colName] = spec
+        return self
+
+    def transform(self, X, n_jobs=1):
+        """
+        对新数据应用全部分箱规则
+
+        parameter:
+        ----------
+        X : DataFrame
+            需要分箱的数据，需包含全部规则中的特征
+        n_jobs : Int, default 1
+            按特征并行的线程数
+
+        return:
+        ----------
+        X_box : DataFrame
+            分箱后的数据，列的顺序和规则的顺序一致
+        """
+        colNames = list(self.specs.keys())
+
+        def transformColumn(colName):
+            return self.specs[colName].transform(X[colName].to_numpy())
+
+        if n_jobs <= 1:
+            columns = [transformColumn(colName) for colName in colNames]
+        else:
+            with ThreadPoolExecutor(max_workers=n_jobs) as pool:
+                columns = list(pool.map(transformColumn, colNames))
+        X_box = pd.DataFrame(dict(zip(colNames, columns)), index=X.index, columns=colNames, copy=False)
+        return X_box
+
+    def to_dict(self):
+        return {'specs': [spec.to_dict() for spec in self.specs.values()]}
+
+    @classmethod
+    def from_dict(cls, specSet):
+        return cls([BinSpec.from_dict(spec) for spec in specSet['specs']])
+
+    def save(self, path):
+        """
+        保存为json文件
+        """
+        with open(path, 'w', encoding='utf-8') as f:
+            json.dump(self.to_dict(), f, ensure_ascii=False)
+        return
+
+    @classmethod
+    def load(cls, path):
+        """
+        读取json文件
+        """
+        with open(path, encoding='utf-8') as f:
+            return cls.from_dict(json.load(f))
+
+
+def _to_python(value):
+    # numpy的标量转为python类型，json才能保存
+    if isinstance(value, np.generic):
+        value = value.item()
+    if isinstance(value, float) and np.isnan(value):
+        return None
+    return value
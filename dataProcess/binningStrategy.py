@@ -7,6 +7,14 @@
 *********************************************************************
 *     binning_category0()       *      离散值特征分箱方法               *
 *********************************************************************
+*     binning_batch()           *      多列并行批量分箱                 *
+*********************************************************************
+*     binning_continuous_stream()*     分块读取的连续值特征分箱          *
+*********************************************************************
+*     binning_continuous_optimal()*    单调约束的最优分箱                *
+*********************************************************************
+*     records_frame()           *      各列分箱过程的耗时和迭代次数        *
+*********************************************************************
 *     __orderCategory_bins()    *      有序离散特征分箱                *
 *********************************************************************
 *     __merging_counts()        *      选择最小的箱子向前或者向后合并     *
@@ -21,41 +29,71 @@
 *********************************************************************
 *     __bins_dict_replace()     *      根据bins字典替换原值            *
 *********************************************************************
+*     merge_bins_by_counts()    *      按箱子计数合并最小箱子            *
+*********************************************************************
+*     merge_bins_by_chi2()      *      按标签计数做卡方合并              *
+*********************************************************************
+*     merge_bins_monotonic()    *      单调约束下的动态规划最优分箱        *
+*********************************************************************
+*     LabelCountTable           *      特征取值的标签计数表              *
+*********************************************************************
+*     SortedColumn              *      连续特征排序一次后的表示           *
+*********************************************************************
 
 """
 
+import heapq
+import time
 import numpy as np
 import pandas as pd
-from scipy import stats
-from utils.utils import is_monotonic
+from concurrent.futures import ProcessPoolExecutor
+from dataProcess.quantileSketch import QuantileSketch
+try:
+    from multiprocessing import shared_memory
+except ImportError:
+    # python3.8以下没有共享内存，批量分箱时把列数据直接传给子进程
+    shared_memory = None
 
 __all__ = ['BinningMethod']
 
+# BinningMethod.records中每条记录的字段
+_RECORD_COLUMNS = ['column', 'method', 'rows', 'bins_initial', 'bins_final', 'time_qcut', 'time_counts', 'time_chi2',
+                   'time_monotonic', 'time_optimal', 'time_total', 'iters_counts', 'iters_chi2']
+
 
 class BinningMethod(object):
+    def __init__(self, verbose=True):
+        """
+        parameter:
+        ----------
+        verbose : Bool, default True
+            是否打印分箱过程，False时不做任何字符串格式化，
+            各列的耗时、迭代次数和箱子个数始终记录在records中
+        """
+        self.verbose = verbose
+        self.records = []
+        self.__record = None
 
     # 1、连续值等频分箱，有缺失的单独一项
     def binning_continuous0(self, X, colName, labelName, n, box_thres=5, fillna=-99):
+        start = self.__start_record(colName, 'continuous', X.shape[0])
+        # 排序一次，等频切分点、细分箱的标签计数、最后的分箱都由排序后的数据得到
+        column = SortedColumn(X[colName], X[labelName], fillna)
         # 有缺失的单独分为一箱
-        if sum(X[colName] == fillna) > 0:
+        if column.nMissing > 0:
             box_thres -= 1
-            # 接着等频分箱，并获得分箱后的结果
-            ss, bins0 = pd.qcut(X[colName].iloc[np.nonzero(X[colName].values != fillna)[0]], n, retbins=True, duplicates='drop')
-            bins0[0] = bins0[0] - 0.01
-            Xarray = pd.cut(X[colName].iloc[np.nonzero(X[colName].values != fillna)[0]], bins0, labels=list(range(len(bins0) - 1))).astype(int)
-            # 等频分箱后，继续按照有序离散变量的分箱方法进行操作
-            bins1 = self.__orderCategory_bins(Xarray, X[labelName], box_thres)
-            bins = [bins0[0]] + [bins0[i+1] for i in bins1[1:]]
+        # 接着等频分箱，并获得分箱后的结果
+        bins0 = column.qcut_edges(n)
+        bins0[0] = bins0[0] - 0.01
+        table = column.fine_table(bins0)
+        self.__add_time('time_qcut', start)
+        # 等频分箱后，继续按照有序离散变量的分箱方法进行操作
+        bins1 = self.__orderCategory_table(table, box_thres)
+        bins = [bins0[0]] + [bins0[i + 1] for i in bins1[1:]]
+        if column.nMissing > 0:
             bins = [fillna - 0.01] + bins
-        else:
-            ss, bins0 = pd.qcut(X[colName], n, retbins=True, duplicates='drop')
-            bins0[0] = bins0[0] - 0.01
-            Xarray = pd.cut(X[colName].iloc[np.nonzero(X[colName].values != fillna)[0]], bins0, labels=list(range(len(bins0) - 1))).astype(int)
-            # 等频分箱后，继续按照有序离散变量的分箱方法进行操作
-            bins1 = self.__orderCategory_bins(Xarray, X[labelName], box_thres)
-            bins = [bins0[0]] + [bins0[i + 1] for i in bins1[1:]]
-        X_box = pd.cut(X[colName], bins, labels=list(range(len(bins) - 1)))
-        X_box = X_box.astype(int)
+        X_box = pd.Series(column.cut(bins), index=X.index, name=colName)
+        self.__finish_record(start, bins)
         return X_box, bins
 
     # 2、分类值分箱
@@ -68,9 +106,11 @@ class BinningMethod(object):
             可以先最小箱子向前或者向后合并，如果合并出来的分箱是单调的，则停止，
             否则尝试卡方分箱方法。
         """
+        start = self.__start_record(colName, 'category_order' if order else 'category', X.shape[0])
         Xarray = X[colName]
         label = X[labelName]
-        if Xarray.unique().__len__() <= box_thres:
+        self.__record['bins_initial'] = Xarray.unique().__len__()
+        if self.__record['bins_initial'] <= box_thres:
             # 箱子个数少的不需要再分箱
             X_box = Xarray
             bins = None
@@ -79,11 +119,13 @@ class BinningMethod(object):
             ## 0、合并箱子，得到bins，字典格式
             bins = self.__noorderCategory_bins(Xarray, ratioThres=0.95)
             Xarraytemp = self.__bins_dict_replace(Xarray, bins)
-            print(f"第一次合并后的bins是{bins}")
+            if self.verbose:
+                print(f"第一次合并后的bins是{bins}")
             ## 1、分箱后箱子数量太多，就再次进行分箱计数，替换掉bins
             if bins.__len__() > box_thres+1:
                 bins1 = self.__LargeCategory_bins(Xarraytemp, label)
-                print(f"第二次分箱计数后的bins是{bins1}")
+                if self.verbose:
+                    print(f"第二次分箱计数后的bins是{bins1}")
                 for k, v in bins.items():
                     bins[k] = bins1[v]
             ## 2、根据bins替换原值
@@ -92,7 +134,8 @@ class BinningMethod(object):
             # 有序离散特征
             ## 0、合并箱子，先判断是否有缺失一类的箱子，有的话，单独拿出来
             if sum(Xarray == fillna) > 0:
-                print("有缺失值的分箱，单独作为一类！")
+                if self.verbose:
+                    print("有缺失值的分箱，单独作为一类！")
                 ### 目标箱数减1
                 box_thres -= 1
                 ### 取出非Nan的特征和标签
@@ -105,14 +148,228 @@ class BinningMethod(object):
                 bins = [fillna - 0.01] + bins
             else:
                 bins = self.__orderCategory_bins(Xarray, label, box_thres)
-            print(f"最后分箱结果是{bins}")
+            if self.verbose:
+                print(f"最后分箱结果是{bins}")
             ## 1、根据bins替换原值
             X_box = pd.cut(Xarray, bins, labels=list(range(len(bins) - 1)))
             X_box = X_box.astype(int)
         else:
             pass
+        self.__finish_record(start, bins)
+        return X_box, bins
+
+    # 3、多列批量分箱
+    def binning_batch(self, X, labelName, options, n_jobs=1):
+        """
+        多列批量分箱，用进程池按列并行。
+        特征列和标签放在共享内存中，子进程按名字挂载，不用把整个数据集序列化给每个子进程；
+        字符型的列先factorize成整数编码再放入共享内存。
+        子进程中各列的分箱记录汇总到self.records。
+
+        Parameters
+        ----------
+        X : DataFrame
+            数据集.
+        labelName : String
+            标签名称.
+        options : Dict
+            {特征名称: 分箱参数}，分箱参数为字典，
+            'kind'为'continuous'（调用binning_continuous0，需要'n'）、'optimal'（调用binning_continuous_optimal，需要'n'）
+            或'category'（调用binning_category0），
+            其余的键如'order'、'box_thres'、'fillna'原样传给对应的分箱方法.
+        n_jobs : Int, default 1
+            进程数，1为在当前进程中依次分箱.
+
+        Returns
+        -------
+        bins : Dict
+            {特征名称: 分箱结果bins}.
+        X_box : DataFrame
+            分箱后的数据，只包含分箱成功的特征.
+        errors : Dict
+            {特征名称: 错误信息}，单列失败不影响其他列.
+
+        """
+        colNames = list(options.keys())
+        if n_jobs <= 1:
+            results = [_binning_column(X[colName], X[labelName], options[colName], self.verbose) for colName in colNames]
+        else:
+            results = _binning_columns_parallel(X, labelName, colNames, options, n_jobs, self.verbose)
+        bins, boxes, errors = {}, {}, {}
+        for colName, (X_box, colBins, error, records) in zip(colNames, results):
+            # 子进程中的分箱记录汇总到当前对象，列名换回原来的特征名称
+            for record in records:
+                record['column'] = colName
+            self.records.extend(records)
+            if error is not None:
+                errors[colName] = error
+                continue
+            bins[colName] = colBins
+            boxes[colName] = pd.Series(X_box, index=X.index, name=colName)
+        X_box = pd.DataFrame(boxes, index=X.index)
+        return bins, X_box, errors
+
+    # 4、分块读取的连续值分箱
+    def binning_continuous_stream(self, chunks, colName, labelName, n, box_thres=5, fillna=-99, sketchSize=2000):
+        """
+        binning_continuous0的流式版本，数据不需要一次性读入内存，分两遍遍历数据块：
+        第一遍用QuantileSketch求近似的等频切分点，并统计缺失（等于fillna）的个数；
+        第二遍按切分点统计每个细分箱的标签计数。
+        之后的最小箱子合并、卡方合并都只用汇总后的标签计数，和binning_continuous0一致。
+        等频切分点是近似的，每个切分点的秩误差不超过rank_error * 非缺失样本数，
+        约为log2(样本数/sketchSize)/sketchSize。
+
+        Parameters
+        ----------
+        chunks : Callable Or List[DataFrame]
+            数据块，需要能遍历两遍：
+            可以是每次调用返回一个新迭代器的函数，如lambda: pd.read_csv(path, usecols=[colName, labelName], chunksize=100000)，
+            也可以是DataFrame的列表.
+        colName : String
+            特征名称.
+        labelName : String
+            标签名称.
+        n : Int
+            等频分箱的箱数.
+        box_thres : Int, default 5
+            分箱的目标个数.
+        fillna : Float, default -99
+            缺失的填充值，有缺失的单独分为一箱.
+        sketchSize : Int, default 2000
+            QuantileSketch每层的容量.
+
+        Returns
+        -------
+        bins : List
+            分箱的切分点.
+        rank_error : Float
+            等频切分点秩误差占样本数比例的上界.
+
+        """
+        start = self.__start_record(colName, 'stream', 0)
+        if callable(chunks):
+            iterChunks = chunks
+        elif iter(chunks) is chunks:
+            raise ValueError("chunks只能遍历一次，请传入返回迭代器的函数或DataFrame的列表")
+        else:
+            iterChunks = lambda: iter(chunks)
+        ## 0、第一遍：近似分位数和缺失个数
+        sketch = QuantileSketch(sketchSize)
+        nMissing = 0
+        for chunk in iterChunks():
+            values = chunk[colName].to_numpy(dtype=np.float64)
+            isMissing = values == fillna
+            nMissing += int(isMissing.sum())
+            sketch.update(values[~isMissing])
+        if nMissing > 0:
+            box_thres -= 1
+        bins0 = np.unique(sketch.quantiles(np.linspace(0, 1, n + 1)))
+        bins0[0] = bins0[0] - 0.01
+        nBins = len(bins0) - 1
+        ## 1、第二遍：每个细分箱的标签计数
+        labelCounts = {}
+        for chunk in iterChunks():
+            values = chunk[colName].to_numpy(dtype=np.float64)
+            notMissing = (values != fillna) & ~np.isnan(values)
+            codes = np.searchsorted(bins0, values[notMissing], side='left') - 1
+            np.clip(codes, 0, nBins - 1, out=codes)
+            labels, yCode = np.unique(chunk[labelName].to_numpy()[notMissing], return_inverse=True)
+            for j, label in enumerate(labels):
+                counts = np.bincount(codes[yCode.ravel() == j], minlength=nBins)
+                labelCounts[label] = labelCounts.get(label, 0) + counts
+        labels = np.array(sorted(labelCounts.keys()))
+        counts = np.column_stack([labelCounts[label] for label in labels])
+        nonEmpty = counts.sum(axis=1) > 0
+        ## 2、细分箱编码作为有序离散特征，继续按照有序离散变量的分箱方法进行操作
+        table = LabelCountTable.from_counts(np.nonzero(nonEmpty)[0], labels, counts[nonEmpty])
+        self.__record['rows'] = sketch.n + nMissing
+        self.__add_time('time_qcut', start)
+        bins1 = self.__orderCategory_table(table, box_thres)
+        bins = [bins0[0]] + [bins0[i + 1] for i in bins1[1:]]
+        if nMissing > 0:
+            bins = [fillna - 0.01] + bins
+        self.__finish_record(start, bins)
+        return bins, sketch.rank_error()
+
+    # 5、单调约束下的最优分箱
+    def binning_continuous_optimal(self, X, colName, labelName, n, box_thres=5, fillna=-99, objective='iv', minRatio=0.05):
+        """
+        先和binning_continuous0一样等频分为n个细分箱，再在细分箱的标签计数上用动态规划
+        求箱子个数不超过box_thres、各箱标签均值单调（递增或递减）、目标值最大的分箱，
+        不用贪心合并和卡方合并，结果确定，耗时只和细分箱个数有关，和样本数无关。
+
+        Parameters
+        ----------
+        X : DataFrame
+            数据集.
+        colName : String
+            特征名称.
+        labelName : String
+            标签名称.
+        n : Int
+            等频分箱的细分箱个数.
+        box_thres : Int, default 5
+            分箱的最大个数，有缺失时缺失单独占一箱.
+        fillna : Float, default -99
+            缺失的填充值.
+        objective : String, default 'iv'
+            最大化的目标，'iv'或'chi2'.
+        minRatio : Float, default 0.05
+            每箱样本数占非缺失样本数的最小比例.
+
+        Returns
+        -------
+        X_box : Series
+            分箱后的值.
+        bins : List
+            分箱的切分点.
+
+        """
+        start = self.__start_record(colName, 'optimal', X.shape[0])
+        column = SortedColumn(X[colName], X[labelName], fillna)
+        if column.nMissing > 0:
+            box_thres -= 1
+        bins0 = column.qcut_edges(n)
+        bins0[0] = bins0[0] - 0.01
+        table = column.fine_table(bins0)
+        self.__add_time('time_qcut', start)
+        self.__record['bins_initial'] = len(table.values)
+        t0 = time.perf_counter()
+        positions, monotonic = merge_bins_monotonic(table, box_thres, objective, minRatio)
+        self.__add_time('time_optimal', t0)
+        if self.verbose:
+            print(f"最优分箱的单调性是{monotonic}")
+        bins = [bins0[0]] + [bins0[table.values[i - 1] + 1] for i in positions[1:]]
+        if column.nMissing > 0:
+            bins = [fillna - 0.01] + bins
+        X_box = pd.Series(column.cut(bins), index=X.index, name=colName)
+        self.__finish_record(start, bins)
         return X_box, bins
 
+    def records_frame(self):
+        """
+        各列分箱过程的记录，每行为一次分箱调用：
+        column、method、rows、bins_initial（合并前的箱子个数）、bins_final（最终的箱子个数，不分箱时为None），
+        time_qcut（排序和等频分箱）、time_counts（最小箱子合并）、time_chi2（卡方合并，含其中每轮的单调性判断）、
+        time_monotonic（最小箱子合并后的单调性判断）、time_optimal（动态规划）、time_total，单位为秒，
+        iters_counts、iters_chi2为两种合并的合并次数
+        """
+        return pd.DataFrame(self.records, columns=_RECORD_COLUMNS)
+
+    def __start_record(self, colName, method, rows):
+        self.__record = dict.fromkeys(_RECORD_COLUMNS, 0)
+        self.__record.update({'column': colName, 'method': method, 'rows': rows, 'bins_initial': None, 'bins_final': None})
+        return time.perf_counter()
+
+    def __add_time(self, key, t0):
+        self.__record[key] += time.perf_counter() - t0
+
+    def __finish_record(self, start, bins):
+        self.__record['bins_final'] = None if bins is None else len(bins) - (0 if isinstance(bins, dict) else 1)
+        self.__add_time('time_total', start)
+        self.records.append(self.__record)
+        self.__record = None
+
 
     # 有序离散特征的分箱
     def __orderCategory_bins(self, Xarray, ylabel, n):
@@ -134,35 +391,58 @@ class BinningMethod(object):
             分箱的切分点.
 
         """
+        ### 按特征的每个取值汇总标签的计数，后面的合并和单调性判断都只用汇总后的计数
+        table = LabelCountTable(Xarray, ylabel)
+        return self.__orderCategory_table(table, n)
+
+
+    def __orderCategory_table(self, table, n):
+        """
+        由标签计数表进行有序离散特征的分箱，流式分箱时直接传入分块汇总的计数表
+        """
+        if self.__record['bins_initial'] is None:
+            self.__record['bins_initial'] = len(table.values)
         ### 最小的箱子向前或者向后合并
-        Xset = list(np.unique(Xarray))
+        Xset = list(table.values)
         bins0 = [Xset[0] - 0.01] + Xset
-        bins = self.__merging_counts(Xarray, bins0, n)
-        print(f">>>最小箱子合并结束，bins是{bins}")
+        t0 = time.perf_counter()
+        bins = self.__merging_counts(table, bins0, n)
+        self.__add_time('time_counts', t0)
+        if self.verbose:
+            print(f">>>最小箱子合并结束，bins是{bins}")
         ### 判断单调性
-        monotonic = self.__judge_monotonic(Xarray, ylabel, bins)
+        t0 = time.perf_counter()
+        monotonic = self.__judge_monotonic(table, bins)
+        self.__add_time('time_monotonic', t0)
         ### 判断是否进行其他分箱，没有单调性则重新分箱
         if monotonic:
-            print(f"单调性是{monotonic}")
-            print("分箱结束！")
+            if self.verbose:
+                print(f"单调性是{monotonic}")
+                print("分箱结束！")
         else:
-            print(">>>开始卡方分箱")
-            bins = self.__merging_chi2(Xarray, ylabel, bins0, n)
-            print(f"卡方分箱结束，bins是{bins}")
+            if self.verbose:
+                print(">>>开始卡方分箱")
+            t0 = time.perf_counter()
+            bins = self.__merging_chi2(table, bins0, n)
+            self.__add_time('time_chi2', t0)
+            if self.verbose:
+                print(f"卡方分箱结束，bins是{bins}")
         return bins
 
 
     # 选择最小的箱子，向前或者向后合并箱子
-    def __merging_counts(self, Xarray, bins, n):
+    def __merging_counts(self, table, bins, n):
         """
         最小箱子向前或者向后合并。
+        箱子计数由标签计数表一次算出，之后用双向链表维护相邻的箱子，
+        用小顶堆找最小的箱子，每次合并只更新合并后的箱子计数。
 
         Parameters
         ----------
-        Xarray : 1D array-like
-            特征数据.
+        table : LabelCountTable
+            特征每个取值的标签计数.
         bins : List
-            分箱切分点.
+            分箱切分点，会被原地修改.
         n : Int
             分箱的目标个数.
 
@@ -172,46 +452,30 @@ class BinningMethod(object):
             分箱的切分点.
 
         """
-        while len(bins) > n+1:
-            minCount = np.inf
-            minIdx = 0
-            CountDict = {}
-            # 找到最小的箱子数量、箱子下标
-            for idx, bin in enumerate(bins):
-                if idx==0:
-                    continue
-                bin0 = bins[idx-1]
-                bin1 = bin
-                XiCount = sum((Xarray>bin0)&(Xarray<=bin1))
-                if XiCount < minCount:
-                    minIdx = idx
-                    minCount = XiCount
-                CountDict[idx] = XiCount
-            # 根据最小箱子判断向前合并还是向后合并
-            if minIdx == 1:
-                bins.pop(minIdx)
-            elif minIdx == len(bins)-1:
-                bins.pop(minIdx-1)
-            elif CountDict[minIdx-1] <= CountDict[minIdx+1]:
-                bins.pop(minIdx - 1)
-            else:
-                bins.pop(minIdx)
+        if len(bins) <= n + 1:
+            return bins
+        # 第i个箱子为(bins[i-1], bins[i]]，counts[i]为箱子内的样本数，区间外的样本不计
+        binCounts = table.bin_counts(table.edge_positions(bins)).sum(axis=1)
+        counts = [0] + binCounts.tolist()
+        mergedBins = merge_bins_by_counts(counts, n)
+        self.__record['iters_counts'] += len(bins) - len(mergedBins)
+        bins[:] = [bins[i] for i in mergedBins]
         return bins
 
 
     # 按照卡方进行分箱
-    def __merging_chi2(self, Xarray, ylabel, bins, n):
+    def __merging_chi2(self, table, bins, n):
         """
         卡方分箱，个数小于指定箱数，并且要符合单调性，才停止分箱。
+        相邻两箱的卡方值按两箱内各取值的标签计数直接计算，放在小顶堆中，
+        每次合并后只重新计算受影响的前后两个卡方值，单调性也由各箱的标签计数判断。
 
         Parameters
         ----------
-        Xarray : 1D array-like
-            特征数据.
-        ylabel : 1D array-like
-            标签数据.
+        table : LabelCountTable
+            特征每个取值的标签计数.
         bins : List
-            分箱的节点.
+            分箱的节点，会被原地修改.
         n : Int
             分箱的目标个数
 
@@ -221,42 +485,22 @@ class BinningMethod(object):
             分箱的切分点.
 
         """
-        flag = True
-        while (len(bins) > n + 1) or flag:
-            minChi2 = np.inf
-            minIdx = 0
-            # 找到最小的临近卡方值
-            for idx, bin in enumerate(bins):
-                if (idx == 0) or (idx == len(bins)-1):
-                    continue
-                usedIdx = np.nonzero((Xarray.values>bins[idx-1])&(Xarray.values<=bins[idx+1]))[0]
-                cross_table = pd.crosstab(columns=ylabel.iloc[usedIdx], index=Xarray.iloc[usedIdx])
-                chiq, pValue, df, expected_freq = stats.chi2_contingency(cross_table)
-                if chiq < minChi2:
-                    minIdx = idx
-                    minChi2 = chiq
-            # 合并最小的临近卡方值
-            bins.pop(minIdx)
-            # 检验单调性
-            monotonic = self.__judge_monotonic(Xarray, ylabel, bins)
-            if monotonic:
-                flag = False
-            else:
-                flag = True
-        print(f"单调性是{monotonic}")
+        keep, monotonic = merge_bins_by_chi2(table, table.edge_positions(bins), n)
+        self.__record['iters_chi2'] += len(bins) - len(keep)
+        bins[:] = [bins[i] for i in keep]
+        if self.verbose:
+            print(f"单调性是{monotonic}")
         return bins
 
 
-    def __judge_monotonic(self, Xarray, ylabel, bins):
+    def __judge_monotonic(self, table, bins):
         """
-        判断单调性，在utils中的is_monotonic的基础上进行修改
+        判断单调性，按各箱的标签均值判断
 
         Parameters
         ----------
-        Xarray : 1D array-like
-            特征数据.
-        ylabel : 1D array-like
-            标签数据.
+        table : LabelCountTable
+            特征每个取值的标签计数.
         bins : List
             分箱的节点.
 
@@ -266,10 +510,7 @@ class BinningMethod(object):
             单调性判断，有“递增”、“递减”、None
 
         """
-        # 按照分箱节点切分后的数据
-        Xarraybins = pd.cut(Xarray, bins, labels=list(range(len(bins) - 1)))
-        # 调用is_monotonic函数进行判断单调性
-        flag = is_monotonic(pd.DataFrame({'feature': Xarraybins.astype(int), 'label': ylabel}), 'feature', 'label')
+        flag = table.judge_monotonic(table.edge_positions(bins))
         return flag
 
 
@@ -290,24 +531,451 @@ class BinningMethod(object):
 
     # 无序大型分类变量进行分箱计数
     def __LargeCategory_bins(self, Xarray, y):
+        """
+        每个类别的对数几率log((正样本数+exp)/(负样本数+exp))，
+        factorize后用bincount一次统计所有类别的正负样本数。
+        """
         exp = 1.0e-5
-        ySet = np.unique(y)
-        xSet = np.unique(Xarray)
-        bins = {}
-        for j in xSet:
-            bins[j] = np.log((sum((y == 1) & (Xarray == j)) + exp) / (sum((y != 1) & (Xarray == j)) + exp))
+        if isinstance(Xarray, pd.Series) and isinstance(y, pd.Series) and len(Xarray) != len(y):
+            y = y.loc[Xarray.index]
+        codes, xSet = pd.factorize(np.asarray(Xarray), sort=True)
+        notNan = codes >= 0
+        codes = codes[notNan]
+        positive = np.bincount(codes, weights=(np.asarray(y) == 1)[notNan], minlength=len(xSet))
+        negative = np.bincount(codes, minlength=len(xSet)) - positive
+        logodds = np.log((positive + exp) / (negative + exp))
+        bins = dict(zip(xSet, logodds))
         return bins
 
 
     # 根据bins字典替换掉原值
     def __bins_dict_replace(self, Xarray, bins):
-        X_box = Xarray.copy()
-        for i in Xarray.unique():
-            if i in bins.keys():
-                X_box.replace({i: bins[i]}, inplace=True)
-            else:
-                X_box.replace({i: bins['other']}, inplace=True)
+        """
+        按bins字典替换原值，字典中没有的值替换为bins['other']，
+        每个不同的值只查一次字典，再按factorize的编码一次性取值。
+        """
+        codes, uniques = pd.factorize(Xarray, use_na_sentinel=False)
+        mapped = np.empty(len(uniques), dtype=object)
+        mapped[:] = [bins[i] if i in bins.keys() else bins['other'] for i in uniques]
+        X_box = pd.Series(mapped[codes], index=Xarray.index, name=Xarray.name).infer_objects()
         return X_box
 
 
+def merge_bins_by_counts(counts, n):
+    """
+    按箱子计数做最小箱子合并，结果和逐轮扫描全部箱子的合并方式完全一致：
+    每轮找计数最小的箱子（计数相同时取最靠前的），
+    第一个箱子向后合并，最后一个箱子向前合并，
+    中间的箱子向前后两个箱子中计数较小的合并（相同时向前合并）。
+
+    Parameters
+    ----------
+    counts : List[Int]
+        counts[i]为第i个切分点左侧箱子的计数，counts[0]不使用.
+    n : Int
+        分箱的目标个数.
+
+    Returns
+    -------
+    keep : List[Int]
+        保留下来的切分点下标.
+
+    """
+    m = len(counts)
+    counts = list(counts)
+    # 切分点的双向链表，下标m为哨兵
+    prevIdx = list(range(-1, m))
+    nextIdx = list(range(1, m + 2))
+    alive = [True] * m
+    heap = [(counts[i], i) for i in range(1, m)]
+    heapq.heapify(heap)
+    nEdges = m
+    while nEdges > n + 1:
+        count, minIdx = heapq.heappop(heap)
+        if not alive[minIdx] or counts[minIdx] != count:
+            continue
+        p, nx = prevIdx[minIdx], nextIdx[minIdx]
+        if p == 0:
+            # 第一个箱子向后合并
+            removed, target = minIdx, nx
+        elif nx == m or counts[p] <= counts[nx]:
+            # 最后一个箱子，或前一个箱子更小，向前合并
+            removed, target = p, minIdx
+        else:
+            removed, target = minIdx, nx
+        alive[removed] = False
+        nextIdx[prevIdx[removed]] = nextIdx[removed]
+        prevIdx[nextIdx[removed]] = prevIdx[removed]
+        nEdges -= 1
+        if target < m:
+            counts[target] += counts[removed]
+            heapq.heappush(heap, (counts[target], target))
+    return [i for i in range(m) if alive[i]]
+
+
+class LabelCountTable(object):
+    """
+    特征每个取值的标签计数表，counts[i, j]为特征取第i个值、标签取第j个值的样本数。
+    切分点(a, b]对应的取值范围用累计到切分点的取值个数表示，
+    一个箱子的计数就是两个切分点之间的行之和。
+    """
+    def __init__(self, Xarray, ylabel):
+        if isinstance(Xarray, pd.Series) and isinstance(ylabel, pd.Series) and len(Xarray) != len(ylabel):
+            # 特征是剔除缺失后的子集时，按索引取对应的标签
+            ylabel = ylabel.loc[Xarray.index]
+        self.values, xCode = np.unique(np.asarray(Xarray), return_inverse=True)
+        self.labels, yCode = np.unique(np.asarray(ylabel), return_inverse=True)
+        nLabels = len(self.labels)
+        self.counts = np.bincount(xCode.ravel() * nLabels + yCode.ravel(),
+                                  minlength=len(self.values) * nLabels).reshape(len(self.values), nLabels)
+        self.cumCounts = np.vstack([np.zeros((1, nLabels), dtype=self.counts.dtype), np.cumsum(self.counts, axis=0)])
+
+    @classmethod
+    def from_counts(cls, values, labels, counts):
+        """
+        由已经汇总好的计数生成计数表，values需要升序
+
+        parameter:
+        ----------
+        values : 1D array
+            特征的取值.
+        labels : 1D array
+            标签的取值.
+        counts : 2D array
+            counts[i, j]为特征取values[i]、标签取labels[j]的样本数.
+        """
+        table = cls.__new__(cls)
+        table.values = np.asarray(values)
+        table.labels = np.asarray(labels)
+        table.counts = np.asarray(counts, dtype=np.int64)
+        table.cumCounts = np.vstack([np.zeros((1, len(table.labels)), dtype=np.int64), np.cumsum(table.counts, axis=0)])
+        return table
+
+    def edge_positions(self, bins):
+        """
+        各切分点左侧（含）的取值个数
+        """
+        return np.searchsorted(self.values, np.asarray(bins, dtype=float), side='right')
+
+    def bin_counts(self, positions):
+        """
+        相邻切分点之间各箱子的标签计数
+        """
+        positions = np.asarray(positions)
+        return self.cumCounts[positions[1:]] - self.cumCounts[positions[:-1]]
 
+    def judge_monotonic(self, positions):
+        """
+        各箱标签均值的单调性，{“递增”, “递减”, None}，空箱子不参与判断
+        """
+        binCounts = self.bin_counts(positions)
+        total = binCounts.sum(axis=1)
+        rate = binCounts[total > 0] @ self.labels.astype(float) / total[total > 0]
+        diff = np.diff(rate)
+        if np.all(diff >= 0):
+            return "递增"
+        elif np.all(diff <= 0):
+            return "递减"
+        return None
+
+    def chi2(self, start, end):
+        """
+        第start到end-1个取值与标签的列联表卡方值，和stats.chi2_contingency的结果一致
+        （不出现的标签列不参与计算，自由度为1时做Yates修正）
+        """
+        observed = self.counts[start:end]
+        observed = observed[:, observed.sum(axis=0) > 0].astype(np.float64)
+        expected = observed.sum(axis=1, keepdims=True) * observed.sum(axis=0, keepdims=True) / observed.sum()
+        dof = expected.size - sum(expected.shape) + expected.ndim - 1
+        if dof == 0:
+            return 0.0
+        if dof == 1:
+            diff = expected - observed
+            observed = observed + np.minimum(0.5, np.abs(diff)) * np.sign(diff)
+        return ((observed - expected) ** 2 / expected).sum()
+
+
+class SortedColumn(object):
+    """
+    连续特征排序一次后的表示：非缺失值的排序下标、排序后的值、按排序对齐的标签编码和缺失的掩码。
+    等频切分点直接在排序后的值上插值（和pd.qcut的切分点一致），
+    细分箱的边界用searchsorted在排序后的值上查找，不再重复排序和生成临时的Series。
+    """
+    def __init__(self, Xarray, ylabel, fillna=-99):
+        self.values = np.asarray(Xarray, dtype=np.float64)
+        self.missing = self.values == fillna
+        self.nMissing = int(self.missing.sum())
+        # 和pd.qcut一样，NaN不参与切分点的计算
+        notMissing = np.nonzero(~self.missing & ~np.isnan(self.values))[0]
+        self.order = notMissing[np.argsort(self.values[notMissing], kind='mergesort')]
+        self.sortedValues = self.values[self.order]
+        self.labels, yCode = np.unique(np.asarray(ylabel)[self.order], return_inverse=True)
+        self.yCode = yCode.ravel()
+
+    def qcut_edges(self, n):
+        """
+        等频切分点，和pd.qcut(n, duplicates='drop')的切分点一致：
+        分位点按pandas的方式取，用np.quantile的线性插值公式计算，再去重
+        """
+        quantiles = np.linspace(0, 1, n + 1)
+        np.putmask(quantiles, n * quantiles != np.arange(n + 1), np.nextafter(quantiles, 1))
+        m = len(self.sortedValues)
+        virtual = (m - 1) * quantiles
+        lower = np.floor(virtual)
+        gamma = virtual - lower
+        loIdx = np.minimum(lower.astype(np.int64), m - 1)
+        hiIdx = np.minimum(loIdx + 1, m - 1)
+        a, b = self.sortedValues[loIdx], self.sortedValues[hiIdx]
+        diff = b - a
+        edges = np.where(gamma >= 0.5, b - diff * (1 - gamma), a + diff * gamma)
+        return np.unique(edges)
+
+    def fine_table(self, bins0):
+        """
+        按切分点(bins0[i], bins0[i+1]]分为细分箱，细分箱编码作为取值的标签计数表
+        """
+        nBins = len(bins0) - 1
+        bounds = np.searchsorted(self.sortedValues, bins0, side='right')
+        codes = np.repeat(np.arange(nBins), np.diff(bounds))
+        nLabels = len(self.labels)
+        yCode = self.yCode[bounds[0]:bounds[-1]]
+        counts = np.bincount(codes * nLabels + yCode, minlength=nBins * nLabels).reshape(nBins, nLabels)
+        nonEmpty = counts.sum(axis=1) > 0
+        return LabelCountTable.from_counts(np.nonzero(nonEmpty)[0], self.labels, counts[nonEmpty])
+
+    def cut(self, bins):
+        """
+        整列按(bins[i], bins[i+1]]分箱，和pd.cut(...).astype(int)一致，不在切分点范围内的值报错
+        """
+        if np.any(np.diff(bins) <= 0):
+            # 如缺失的箱子-99.01大于非缺失的最小值
+            raise ValueError('bins must increase monotonically.')
+        codes = np.searchsorted(bins, self.values, side='left') - 1
+        if np.isnan(self.values).any() or (codes < 0).any() or (codes >= len(bins) - 1).any():
+            raise ValueError("存在缺失或不在分箱范围内的值，无法转换为整数箱子编码")
+        return codes.astype(int)
+
+
+def merge_bins_by_chi2(table, positions, n):
+    """
+    卡方合并：每轮合并卡方值最小（相同时取最靠前）的相邻两箱，
+    直到箱子个数不超过n且各箱标签均值单调，至少合并一次。
+
+    Parameters
+    ----------
+    table : LabelCountTable
+        特征每个取值的标签计数.
+    positions : 1D array
+        各切分点左侧的取值个数.
+    n : Int
+        分箱的目标个数.
+
+    Returns
+    -------
+    keep : List[Int]
+        保留下来的切分点下标.
+    monotonic : String Or None
+        最终的单调性.
+
+    """
+    m = len(positions)
+    prevIdx = list(range(-1, m))
+    nextIdx = list(range(1, m + 2))
+    alive = np.ones(m, dtype=bool)
+    version = [0] * m
+    # 内部切分点i的卡方值为它左右两个箱子合并后的列联表卡方值
+    heap = [(table.chi2(positions[i - 1], positions[i + 1]), i, 0) for i in range(1, m - 1)]
+    heapq.heapify(heap)
+    nEdges = m
+    monotonic = None
+    flag = True
+    while ((nEdges > n + 1) or flag) and heap:
+        chiq, minIdx, ver = heapq.heappop(heap)
+        if not alive[minIdx] or version[minIdx] != ver:
+            continue
+        alive[minIdx] = False
+        p, nx = prevIdx[minIdx], nextIdx[minIdx]
+        nextIdx[p] = nx
+        prevIdx[nx] = p
+        nEdges -= 1
+        # 只重新计算前后两个切分点的卡方值
+        for i in (p, nx):
+            if 0 < i < m - 1:
+                version[i] += 1
+                heapq.heappush(heap, (table.chi2(positions[prevIdx[i]], positions[nextIdx[i]]), i, version[i]))
+        monotonic = table.judge_monotonic(positions[alive])
+        flag = not monotonic
+    return np.nonzero(alive)[0].tolist(), monotonic
+
+
+def merge_bins_monotonic(table, n, objective='iv', minRatio=0.05, smooth=0.5):
+    """
+    单调约束下的最优分箱：把table的k个取值（细分箱）切成不超过n段，
+    各段标签均值单调递增或单调递减，目标值（各段IV或卡方的和）最大。
+    dp[j, a, b]为前b个取值切成j段、最后一段为[a, b)时的最大目标值，
+    转移时前一段[a', a)的均值不能超过（递减时不能低于）[a, b)的均值，
+    对每个a把候选的a'按均值排序后求前缀最大值，用searchsorted查找，
+    复杂度为O(n * k^2 * log k)。
+
+    Parameters
+    ----------
+    table : LabelCountTable
+        细分箱的标签计数.
+    n : Int
+        分箱的最大个数.
+    objective : String, default 'iv'
+        'iv'为各段IV之和（标签为1的是正样本），'chi2'为分段与标签列联表的卡方值.
+    minRatio : Float, default 0.05
+        每段样本数占总样本数的最小比例.
+    smooth : Float, default 0.5
+        计算WOE时的平滑项.
+
+    Returns
+    -------
+    positions : List[Int]
+        各切分点左侧的取值个数，第一个为0，最后一个为k.
+    monotonic : String
+        “递增”或“递减”.
+
+    """
+    k = len(table.values)
+    cum = table.cumCounts.astype(np.float64)
+    # seg[a, b]为第a到b-1个取值的标签计数
+    seg = cum[None, :, :] - cum[:, None, :]
+    total = seg.sum(axis=2)
+    grand = total[0, k]
+    with np.errstate(invalid='ignore', divide='ignore'):
+        rate = seg @ table.labels.astype(np.float64) / total
+        if objective == 'iv':
+            event = seg[:, :, table.labels == 1].sum(axis=2)
+            nonevent = total - event
+            eventAll, noneventAll = event[0, k], nonevent[0, k]
+            woe = np.log((event + smooth) / (eventAll + smooth) / ((nonevent + smooth) / (noneventAll + smooth)))
+            value = (event / max(eventAll, 1) - nonevent / max(noneventAll, 1)) * woe
+        elif objective == 'chi2':
+            expected = total[:, :, None] * cum[k][None, None, :] / grand
+            value = np.where(expected > 0, (seg - expected) ** 2 / expected, 0).sum(axis=2)
+        else:
+            raise ValueError(f"objective只能是'iv'或'chi2'，不能是{objective}")
+    upper = np.triu(np.ones((k + 1, k + 1), dtype=bool), 1)
+    value = np.where(upper & (total >= max(minRatio * grand, 1)), value, -np.inf)
+    n = max(min(n, k), 1)
+    result = None
+    for sign, monotonic in ((1, "递增"), (-1, "递减")):
+        r = sign * rate
+        dp = np.full((n + 1, k + 1, k + 1), -np.inf)
+        back = np.full((n + 1, k + 1, k + 1), -1, dtype=np.int64)
+        dp[1, 0, :] = value[0, :]
+        for j in range(2, n + 1):
+            for a in range(1, k):
+                prev = dp[j - 1, :a, a]
+                cand = np.nonzero(np.isfinite(prev))[0]
+                if cand.size == 0:
+                    continue
+                order = np.argsort(r[cand, a], kind='mergesort')
+                cand = cand[order]
+                rPrev, prev = r[cand, a], prev[cand]
+                # 按均值排序后的前缀最大值及其位置
+                prefixMax = np.maximum.accumulate(prev)
+                prefixArg = np.maximum.accumulate(np.where(prev == prefixMax, np.arange(cand.size), 0))
+                bs = np.arange(a + 1, k + 1)
+                idx = np.searchsorted(rPrev, r[a, bs], side='right')
+                ok = (idx > 0) & np.isfinite(value[a, bs])
+                bs, idx = bs[ok], idx[ok] - 1
+                dp[j, a, bs] = value[a, bs] + prefixMax[idx]
+                back[j, a, bs] = cand[prefixArg[idx]]
+        # 目标值相同时argmax取第一个，即箱子少的
+        scores = dp[:, :, k]
+        j, a = np.unravel_index(np.argmax(scores), scores.shape)
+        if result is None or scores[j, a] > result[0]:
+            result = (scores[j, a], j, a, back, monotonic)
+    score, j, a, back, monotonic = result
+    positions = [k]
+    end = k
+    while j > 1:
+        positions.append(a)
+        a, end = back[j, a, end], a
+        j -= 1
+    positions.append(0)
+    return positions[::-1], monotonic
+
+
+def _binning_column(Xarray, ylabel, option, verbose=True):
+    """
+    对单列分箱，返回(分箱后的值, bins, 错误信息, 分箱记录)
+    """
+    option = dict(option)
+    kind = option.pop('kind', 'continuous')
+    colName, labelName = '__feature__', '__label__'
+    X = pd.DataFrame({colName: np.asarray(Xarray), labelName: np.asarray(ylabel)})
+    method = BinningMethod(verbose)
+    try:
+        if kind == 'continuous':
+            X_box, bins = method.binning_continuous0(X, colName, labelName, **option)
+        elif kind == 'optimal':
+            X_box, bins = method.binning_continuous_optimal(X, colName, labelName, **option)
+        else:
+            X_box, bins = method.binning_category0(X, colName, labelName, **option)
+    except Exception as e:
+        return None, None, repr(e), []
+    return np.asarray(X_box), bins, None, method.records
+
+
+def _attach_column(spec):
+    # 在子进程中按名字挂载共享内存，取出一列
+    blockName, dtype, shape, colIdx, uniques = spec
+    shm = shared_memory.SharedMemory(name=blockName)
+    block = np.ndarray(shape, dtype=dtype, buffer=shm.buf, order='F')
+    values = block[:, colIdx].copy()
+    shm.close()
+    if uniques is not None:
+        # 字符型的列由编码还原，-1为缺失
+        values = np.where(values >= 0, uniques.take(values, mode='clip'), np.nan)
+    return values
+
+
+def _binning_column_task(task):
+    featureSpec, labelSpec, option, verbose = task
+    if shared_memory is None:
+        Xarray, ylabel = featureSpec, labelSpec
+    else:
+        Xarray, ylabel = _attach_column(featureSpec), _attach_column(labelSpec)
+    return _binning_column(Xarray, ylabel, option, verbose)
+
+
+def _binning_columns_parallel(X, labelName, colNames, options, n_jobs, verbose=True):
+    """
+    按dtype把各列放进共享内存块，用进程池逐列分箱
+    """
+    if shared_memory is None:
+        tasks = [(X[colName].values, X[labelName].values, options[colName], verbose) for colName in colNames]
+        with ProcessPoolExecutor(max_workers=n_jobs) as pool:
+            return list(pool.map(_binning_column_task, tasks))
+    # 按dtype分组，每组一个列优先的共享内存块
+    groups = {}
+    specs = {}
+    for colName in colNames + [labelName]:
+        values = X[colName].to_numpy()
+        uniques = None
+        if values.dtype == object or not isinstance(values.dtype, np.dtype):
+            codes, uniques = pd.factorize(X[colName])
+            values, uniques = codes.astype(np.int64), np.asarray(uniques, dtype=object)
+        groups.setdefault(values.dtype.str, []).append((colName, values, uniques))
+    blocks = []
+    try:
+        for dtype, cols in groups.items():
+            shape = (X.shape[0], len(cols))
+            shm = shared_memory.SharedMemory(create=True, size=max(int(np.prod(shape)) * np.dtype(dtype).itemsize, 1))
+            blocks.append(shm)
+            block = np.ndarray(shape, dtype=dtype, buffer=shm.buf, order='F')
+            for colIdx, (colName, values, uniques) in enumerate(cols):
+                block[:, colIdx] = values
+                specs[colName] = (shm.name, dtype, shape, colIdx, uniques)
+            del block
+        tasks = [(specs[colName], specs[labelName], options[colName], verbose) for colName in colNames]
+        with ProcessPoolExecutor(max_workers=n_jobs) as pool:
+            return list(pool.map(_binning_column_task, tasks))
+    finally:
+        for shm in blocks:
+            shm.close()
+            shm.unlink()
@@ -9,16 +9,24 @@
 *********************************************************************
 *     mathFeatures()            *      特征统计量特征                  *
 *********************************************************************
+*     windowFeatures()          *      多个时间窗口的统计量特征           *
+*********************************************************************
 *     dateFeatures()            *      日期转天数特征                  *
 *********************************************************************
 *     whetherFeatures()         *      转为0-1是否特征                 *
 *********************************************************************
 *     crossFeatures()           *      交叉特征                       *
 *********************************************************************
+*     crossFeaturesBatch()      *      批量生成交叉特征                 *
+*********************************************************************
+*     crossVocab()              *      交叉特征各列的取值表              *
+*********************************************************************
 *     logratioFeatures()        *      转为对数占比特征                 *
 *********************************************************************
 *     percentFeatures()         *      转为百分比的特征                 *
 *********************************************************************
+*     ratioFeaturesBatch()      *      批量生成两两比值特征              *
+*********************************************************************
 *     timezoneFeatures()        *      判断时间区间特征                 *
 *********************************************************************
 *     dayzoneFeatures()         *      判断日期区间特征                 *
@@ -30,6 +38,8 @@
 import numpy as np
 import pandas as pd
 import datetime
+import itertools
+from dataProcess.woeStrategy import iv_from_counts
 
 __all__ = ['DesignMethod']
 
@@ -55,23 +65,15 @@ class DesignMethod(object):
 
         """
 
-        # 判断单调性的函数
-        def monotonicFlag(series):
-            """
-            {0:持平, 1:递增, 2:递减, 3:无单调性}
-            """
-            if series.isnull().sum() > 0:
-                series.fillna(0, inplace=True)
-            if series.is_monotonic_decreasing and series.is_monotonic_increasing:
-                return 0
-            elif series.is_monotonic_increasing:
-                return 1
-            elif series.is_monotonic_decreasing:
-                return 2
-            else:
-                return 3
-
-        monotonic_series = X[colName].apply(monotonicFlag, axis=1)
+        # {0:持平, 1:递增, 2:递减, 3:无单调性}，缺失按0处理
+        # 取出各月份的二维数组，按行求相邻两列的差，不再逐行生成Series
+        block = X[colName].to_numpy(dtype=np.float64)
+        block = np.where(np.isnan(block), 0, block)
+        diff = np.diff(block, axis=1)
+        increasing = (diff >= 0).all(axis=1)
+        decreasing = (diff <= 0).all(axis=1)
+        monotonic_series = pd.Series(np.select([increasing & decreasing, increasing, decreasing], [0, 1, 2], 3),
+                                     index=X.index)
         return monotonic_series
 
 
@@ -123,6 +125,69 @@ class DesignMethod(object):
         math_df[colName + "_" + "std"] = series.std(axis=1)
         return math_df
 
+    # 多个时间窗口的统计量
+    def windowFeatures(self, X, baseName, windows=(3,), stats=None, colList=None):
+        """
+        计算嵌套时间窗口（如近3个月、近6个月、近12个月）的统计量，
+        各月份的列组成一个连续的float32数组，沿月份求一次前缀和、前缀最大最小值，
+        近w个月的统计量直接取第w-1列，窗口再多也不用重复计算。
+        缺失不参与计算，和pandas的max、min、mean、std、sum一致。
+
+        Parameters
+        ----------
+        X : DataFrame
+            数据集.
+        baseName : String
+            特征名称，默认取baseName_m0、baseName_m1...，m0为最近的月份.
+        windows : Tuple[Int], default (3,)
+            窗口的月份数.
+        stats : List[String], default None
+            需要的统计量，None为全部：
+            max、min、mean、std（样本标准差）、sum、diff（最近一个月减窗口内最早的月份）、
+            slope（按时间先后线性回归的斜率）.
+        colList : List[String], default None
+            按m0、m1...顺序排列的月份列，None时按baseName生成.
+
+        Returns
+        -------
+        window_df : DataFrame
+            列名为baseName_统计量_窗口月份数m，如aum_mean_3m，dtype为float32.
+
+        """
+        stats = list(_WINDOW_STATS) if stats is None else list(stats)
+        windows = sorted(windows)
+        if colList is None:
+            colList = [baseName + "_m" + str(i) for i in range(windows[-1])]
+        if windows[-1] > len(colList):
+            raise ValueError(f"{baseName}只有{len(colList)}个月份的列，小于窗口{windows[-1]}")
+        block = np.ascontiguousarray(X[colList[:windows[-1]]].to_numpy(dtype=np.float32))
+        notnull = ~np.isnan(block)
+        values = np.where(notnull, block, 0).astype(np.float64)
+        # 时间x取-i，最近的月份最大，斜率和窗口起点无关
+        x = -np.arange(block.shape[1], dtype=np.float64)
+        count = np.cumsum(notnull, axis=1)
+        sumY = np.cumsum(values, axis=1)
+        prefix = {
+            'count': count,
+            'sum': sumY,
+            'sumYY': np.cumsum(values * values, axis=1),
+            'sumX': np.cumsum(notnull * x, axis=1),
+            'sumXX': np.cumsum(notnull * x * x, axis=1),
+            'sumXY': np.cumsum(values * x, axis=1),
+            'max': np.fmax.accumulate(block, axis=1),
+            'min': np.fmin.accumulate(block, axis=1),
+        }
+        names = _window_names(baseName, windows, stats)
+        window_block = np.empty((X.shape[0], len(names)), dtype=np.float32, order='F')
+        j = 0
+        with np.errstate(invalid='ignore', divide='ignore'):
+            for w in windows:
+                for stat in stats:
+                    window_block[:, j] = _window_stat(prefix, block, stat, w - 1)
+                    j += 1
+        window_df = pd.DataFrame(window_block, index=X.index, columns=names, copy=False)
+        return window_df
+
     # 生成日期特征
     def dateFeatures(self, X, colName, eddt, format='%Y-%m-%d'):
         """
@@ -146,11 +211,10 @@ class DesignMethod(object):
             转换之后的特征
 
         """
-        series = X[colName]
-        if series.isnull().sum() > 0:
-            series.fillna(eddt, inplace=True)
         dataStamp = datetime.datetime.strptime(eddt, format)
-        date_series = (dataStamp - pd.to_datetime(series, format="%Y-%m-%d")).apply(lambda x: x.days)
+        # 缺失以当前日期填缺，解析后填，已经解析成日期的列也可以直接传入
+        dates = _parse_dates(X[colName], format)
+        date_series = (dataStamp - dates.fillna(dataStamp)).dt.days
         return date_series
 
     # 生成0-1标签
@@ -198,10 +262,106 @@ class DesignMethod(object):
         """
         seriesA = X[colNameA]
         seriesB = X[colNameB]
-        cross_series = (seriesA.astype(str) + seriesB.astype(str)).astype(int)
+        if pd.api.types.is_integer_dtype(seriesA.dtype) and pd.api.types.is_integer_dtype(seriesB.dtype) \
+                and not (seriesA.hasnans or seriesB.hasnans) and (seriesB >= 0).all():
+            # 整数的字符串拼接等价于A * 10^(B的位数) ± B，A为负数时减去B，不用逐个转字符串
+            valuesA = seriesA.to_numpy(dtype=np.int64)
+            valuesB = seriesB.to_numpy(dtype=np.int64)
+            digits = np.searchsorted(10 ** np.arange(1, 19, dtype=np.int64), valuesB, side='right') + 1
+            cross = valuesA * 10 ** digits + np.where(valuesA < 0, -valuesB, valuesB)
+            cross_series = pd.Series(cross, index=X.index)
+        else:
+            cross_series = (seriesA.astype(str) + seriesB.astype(str)).astype(int)
         return cross_series
 
 
+    # 批量特征交叉
+    def crossFeaturesBatch(self, X, pairs, hashBuckets=None, vocab=None):
+        """
+        批量生成交叉特征，每个特征只编码一次，交叉的编码用整数运算得到，结果写入一个预先分配的int32矩阵。
+        默认模式下，每个特征按取值表编码：缺失为0，取值表中第i个值为i+1，取值表外的值为len+1，
+        交叉编码为codeA * kB + codeB（kB = 特征B取值表的长度 + 2），编码紧凑，负数、位数很多的ID都可以；
+        取值表由crossVocab在训练数据上生成，打分时传入同一份取值表，编码和训练时一致，
+        vocab为None时用当前数据生成，只适用于同一份数据。
+        hashBuckets不为None时为特征哈希模式，按取值本身的哈希组合后对hashBuckets取余，
+        不需要取值表，并把取值组合很多的交叉特征压缩到hashBuckets个以内，数值型（包括可转为数值的字符串）统一按float64哈希，
+        整数列和出现缺失后变为浮点的同一列得到同样的哈希值。
+
+        Parameters
+        ----------
+        X : DataFrame
+            数据集.
+        pairs : List[Tuple[String, String]]
+            需要交叉的特征对.
+        hashBuckets : Int, default None
+            哈希桶的个数，None为不哈希.
+        vocab : Dict[String, 1D array], default None
+            默认模式下各特征的取值表，即crossVocab的结果，没有给出的特征用当前数据生成.
+
+        Returns
+        -------
+        cross_df : DataFrame
+            交叉特征，列名为特征A_特征B，dtype为int32
+
+        """
+        # 列优先，逐列写入是连续内存，转为DataFrame时也不用复制
+        cross = np.empty((X.shape[0], len(pairs)), dtype=np.int32, order='F')
+        vocab = {} if vocab is None else vocab
+        encoded = {}
+
+        def encode(colName):
+            if colName not in encoded:
+                values = _cross_values(X[colName])
+                if hashBuckets is not None:
+                    encoded[colName] = pd.util.hash_array(values)
+                    return encoded[colName]
+                colVocab = vocab[colName] if colName in vocab else _vocab(values)
+                idx = pd.Index(colVocab).get_indexer(values)
+                # 缺失为0，取值表外为len+1
+                codes = np.where(idx >= 0, idx + 1, len(colVocab) + 1)
+                codes[pd.isnull(values)] = 0
+                encoded[colName] = (codes.astype(np.int64), len(colVocab) + 2)
+            return encoded[colName]
+
+        for j, (colNameA, colNameB) in enumerate(pairs):
+            if hashBuckets is None:
+                (codesA, kA), (codesB, kB) = encode(colNameA), encode(colNameB)
+                if kA * kB > np.iinfo(np.int32).max:
+                    raise ValueError(f"{colNameA}和{colNameB}的取值组合超过int32的范围，请设置hashBuckets")
+                cross[:, j] = codesA * kB + codesB
+            else:
+                hashA, hashB = encode(colNameA), encode(colNameB)
+                # 两个哈希值不对称地组合，A_B和B_A的编码不同，乘法溢出即按2^64取余
+                with np.errstate(over='ignore'):
+                    hashAB = hashA * np.uint64(0x9E3779B97F4A7C15) ^ hashB
+                    hashAB ^= hashAB >> np.uint64(29)
+                cross[:, j] = hashAB % np.uint64(hashBuckets)
+        cross_df = pd.DataFrame(cross, index=X.index, columns=[colNameA + "_" + colNameB for colNameA, colNameB in pairs], copy=False)
+        return cross_df
+
+
+    # 交叉特征的取值表
+    def crossVocab(self, X, colList):
+        """
+        在训练数据上生成交叉特征各列的取值表，打分时传给crossFeaturesBatch的vocab，保证编码一致
+
+        Parameters
+        ----------
+        X : DataFrame
+            训练数据.
+        colList : List[String]
+            需要交叉的特征.
+
+        Returns
+        -------
+        vocab : Dict[String, 1D array]
+            各特征排好序的不重复取值（不含缺失）
+
+        """
+        vocab = dict((colName, _vocab(_cross_values(X[colName]))) for colName in colList)
+        return vocab
+
+
     # 求两个特征的比值取对数
     def logratioFeatures(self, X, colNameA, colNameB):
         """
@@ -252,6 +412,81 @@ class DesignMethod(object):
         return percent_series
 
 
+    # 批量求两两比值特征
+    def ratioFeaturesBatch(self, X, groups, kind='percent', ordered=True, memoryBudget=256 * 2 ** 20, outPath=None,
+                           dtype=np.float32, minVariance=None, minIV=None, label=None, ivBins=10):
+        """
+        每组特征内两两求比值（percentFeatures）或比值的对数（logratioFeatures），
+        按内存预算把样本和特征对切成小块，每块用广播一次算出，直接写入预先分配的数组或内存映射文件。
+        设置了minVariance或minIV时，先逐块统计每个特征对的方差和IV，
+        只有超过阈值的特征对才分配输出并写入，其余的不会整列生成。
+
+        Parameters
+        ----------
+        X : DataFrame
+            数据集.
+        groups : List[List[String]]
+            特征组，只在组内两两组合.
+        kind : String, default 'percent'
+            'percent'为A/(B+exp)，'logratio'为log(A/(B+exp)+exp)，和单个特征的方法一致.
+        ordered : Bool, default True
+            是否同时生成A/B和B/A，False时只生成组内顺序靠前的特征作分子的一种.
+        memoryBudget : Int, default 256MB
+            每块计算时临时数组的内存上限（字节）.
+        outPath : String, default None
+            输出的.npy内存映射文件路径，None为在内存中分配.
+        dtype : numpy dtype, default np.float32
+            计算和输出的dtype.
+        minVariance : Float, default None
+            只保留方差大于该阈值的特征对.
+        minIV : Float, default None
+            只保留IV大于该阈值的特征对，需要label，IV按每个特征对的取值范围等宽分为ivBins箱计算.
+        label : 1D array-like, default None
+            标签，1为正样本.
+        ivBins : Int, default 10
+            计算IV时的箱数.
+
+        Returns
+        -------
+        ratio_df : DataFrame
+            比值特征，列名为特征A_特征B_kind，outPath不为None时数据在内存映射文件中
+
+        """
+        if kind not in ('percent', 'logratio'):
+            raise ValueError(f"kind只能是'percent'或'logratio'，不能是{kind}")
+        if minIV is not None and label is None:
+            raise ValueError("按IV筛选需要传入label")
+        combine = itertools.permutations if ordered else itertools.combinations
+        pairs = [pair for group in groups for pair in combine(group, 2)]
+        columns = list(dict.fromkeys(colName for group in groups for colName in group))
+        block = np.ascontiguousarray(X[columns].to_numpy(dtype=dtype))
+        index = dict((colName, j) for j, colName in enumerate(columns))
+        numer = np.array([index[colNameA] for colNameA, colNameB in pairs], dtype=np.int64)
+        denom = np.array([index[colNameB] for colNameA, colNameB in pairs], dtype=np.int64)
+        nRows = X.shape[0]
+        # 分子、分母、结果三个临时数组
+        cellBytes = 3 * np.dtype(dtype).itemsize
+        pairStep = int(max(1, min(len(pairs), memoryBudget // (cellBytes * min(nRows, 1024)))))
+        rowStep = int(max(1, memoryBudget // (cellBytes * pairStep)))
+        keep = np.ones(len(pairs), dtype=bool)
+        if minVariance is not None or minIV is not None:
+            tiles = lambda: _iter_tiles(block, numer, denom, kind, pairStep, rowStep)
+            keep = _filter_ratio_pairs(tiles, len(pairs), minVariance, minIV, label, ivBins)
+        kept = np.nonzero(keep)[0]
+        numer, denom = numer[kept], denom[kept]
+        names = [pairs[i][0] + "_" + pairs[i][1] + "_" + kind for i in kept]
+        if outPath is None:
+            out = np.empty((nRows, len(kept)), dtype=dtype, order='F')
+        else:
+            out = np.lib.format.open_memmap(outPath, mode='w+', dtype=dtype, shape=(nRows, len(kept)), fortran_order=True)
+        for rows, pairSlice, values in _iter_tiles(block, numer, denom, kind, pairStep, rowStep):
+            out[rows, pairSlice] = values
+        if outPath is not None:
+            out.flush()
+        ratio_df = pd.DataFrame(out, index=X.index, columns=names, copy=False)
+        return ratio_df
+
+
     # 求时间区间特征
     def timezoneFeatures(self, X, colName, format):
         """
@@ -271,24 +506,9 @@ class DesignMethod(object):
             时区的分段特征.
 
         """
-        def judgeTimeZone(timeStamp):
-            """
-            {0:0~6, 1:6~12, 2:12~18, 3:18~24, 99:NaT}
-
-            """
-
-            if pd.isnull(timeStamp):
-                return 99
-            elif 0 <= timeStamp.hour < 6:
-                return 0
-            elif 6 <= timeStamp.hour < 12:
-                return 1
-            elif 12 <= timeStamp.hour < 18:
-                return 2
-            else:
-                return 3
-        timess = pd.to_datetime(X[colName], format=format)
-        timezone_series = timess.apply(judgeTimeZone)
+        # {0:0~6, 1:6~12, 2:12~18, 3:18~24, 99:NaT}
+        timess = _parse_dates(X[colName], format)
+        timezone_series = _zone_codes(timess.dt.hour, [6, 12, 18], timess.isnull())
         return timezone_series
 
 
@@ -311,25 +531,148 @@ class DesignMethod(object):
             上中下旬的分段特征.
 
         """
-        def judgeDayZone(dateStamp):
-            """
-            {0:1~10, 1:11~20, 2:21~31, 99:NaT}
-
-            """
-            if pd.isnull(dateStamp):
-                return 99
-            elif 1 <= dateStamp.day <= 10:
-                return 0
-            elif 11 <= dateStamp.day <= 20:
-                return 1
-            else:
-                return 2
-        dayss = pd.to_datetime(X[colName], format=format)
-        dayzone_series = dayss.apply(judgeDayZone)
+        # {0:1~10, 1:11~20, 2:21~31, 99:NaT}
+        dayss = _parse_dates(X[colName], format)
+        dayzone_series = _zone_codes(dayss.dt.day, [11, 21], dayss.isnull())
         return dayzone_series
 
 
-
-
-
-
+def _parse_dates(series, format):
+    """
+    字符串转为日期，每个不同的字符串只解析一次，再按factorize的编码展开
+    """
+    if pd.api.types.is_datetime64_any_dtype(series):
+        return series
+    codes, uniques = pd.factorize(series)
+    parsed = pd.to_datetime(pd.Series(uniques), format=format).to_numpy()
+    # factorize的缺失编码为-1，取到末尾的NaT
+    parsed = np.append(parsed, np.array(['NaT'], dtype=parsed.dtype))
+    return pd.Series(parsed[codes], index=series.index, name=series.name)
+
+
+def _cross_values(series):
+    """
+    交叉特征的取值统一为规范的类型：数值型（包括nullable整数、bool和可转为数值的字符串）为float64，缺失为NaN，
+    其他为字符串，使编码不受各份数据dtype推断的影响
+    """
+    if pd.api.types.is_numeric_dtype(series.dtype):
+        return series.to_numpy(dtype=np.float64, na_value=np.nan)
+    values = np.asarray(series, dtype=object)
+    try:
+        return pd.to_numeric(values).astype(np.float64)
+    except (ValueError, TypeError):
+        return np.where(pd.isnull(values), None, values.astype(str)).astype(object)
+
+
+def _vocab(values):
+    """
+    排好序的不重复取值，不含缺失
+    """
+    return np.sort(pd.unique(values[~pd.isnull(values)]))
+
+
+def _zone_codes(values, edges, isnull):
+    """
+    按edges把小时、日期等分段为0,1,2...，缺失为99
+    """
+    codes = np.digitize(values.fillna(0).to_numpy(), edges)
+    return pd.Series(np.where(isnull.to_numpy(), 99, codes).astype(np.int64), index=values.index)
+
+
+# windowFeatures支持的统计量
+_WINDOW_STATS = ['max', 'min', 'mean', 'std', 'sum', 'diff', 'slope']
+
+
+def _window_names(baseName, windows, stats=None):
+    stats = _WINDOW_STATS if stats is None else stats
+    return [baseName + "_" + stat + "_" + str(w) + "m" for w in sorted(windows) for stat in stats]
+
+
+def _window_stat(prefix, block, stat, k):
+    """
+    由前缀和求前k+1个月的统计量
+    """
+    count = prefix['count'][:, k]
+    if stat in ('max', 'min'):
+        return prefix[stat][:, k]
+    if stat == 'sum':
+        return prefix['sum'][:, k]
+    if stat == 'mean':
+        return prefix['sum'][:, k] / count
+    if stat == 'std':
+        var = (prefix['sumYY'][:, k] - prefix['sum'][:, k] ** 2 / count) / (count - 1)
+        return np.where(count > 1, np.sqrt(np.maximum(var, 0)), np.nan)
+    if stat == 'diff':
+        return block[:, 0] - block[:, k]
+    if stat == 'slope':
+        sxx = count * prefix['sumXX'][:, k] - prefix['sumX'][:, k] ** 2
+        sxy = count * prefix['sumXY'][:, k] - prefix['sumX'][:, k] * prefix['sum'][:, k]
+        return np.where(sxx > 0, sxy / sxx, np.nan)
+    raise ValueError(f"不支持的统计量{stat}，可选{_WINDOW_STATS}")
+
+
+def _ratio_tile(block, numer, denom, kind):
+    """
+    一块样本上多个特征对的比值，和percentFeatures、logratioFeatures的公式一致
+    """
+    exp = block.dtype.type(1.0e-4)
+    values = block[:, numer]
+    values /= block[:, denom] + exp
+    if kind == 'logratio':
+        values += exp
+        np.log(values, out=values)
+    return values
+
+
+def _iter_tiles(block, numer, denom, kind, pairStep, rowStep):
+    """
+    按特征对和样本切块，逐块返回(样本切片, 特征对切片, 比值)
+    """
+    for pairStart in range(0, len(numer), pairStep):
+        pairSlice = slice(pairStart, pairStart + pairStep)
+        for rowStart in range(0, block.shape[0], rowStep):
+            rows = slice(rowStart, rowStart + rowStep)
+            yield rows, pairSlice, _ratio_tile(block[rows], numer[pairSlice], denom[pairSlice], kind)
+
+
+def _filter_ratio_pairs(tiles, nPairs, minVariance, minIV, label, ivBins):
+    """
+    逐块统计每个特征对的方差和IV，返回是否保留，只统计有限的值
+    """
+    count = np.zeros(nPairs)
+    total = np.zeros(nPairs)
+    totalSq = np.zeros(nPairs)
+    low = np.full(nPairs, np.inf)
+    high = np.full(nPairs, -np.inf)
+    for rows, pairSlice, values in tiles():
+        finite = np.isfinite(values)
+        values = np.where(finite, values, 0).astype(np.float64)
+        count[pairSlice] += finite.sum(axis=0)
+        total[pairSlice] += values.sum(axis=0)
+        totalSq[pairSlice] += (values * values).sum(axis=0)
+        low[pairSlice] = np.minimum(low[pairSlice], np.where(finite, values, np.inf).min(axis=0))
+        high[pairSlice] = np.maximum(high[pairSlice], np.where(finite, values, -np.inf).max(axis=0))
+    keep = np.ones(nPairs, dtype=bool)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        if minVariance is not None:
+            variance = (totalSq - total ** 2 / count) / (count - 1)
+            keep &= variance > minVariance
+    if minIV is not None:
+        # 第二遍：按各特征对的取值范围等宽分箱，偏移编码后一次bincount统计正负样本数
+        isEvent = np.asarray(label) == 1
+        event = np.zeros((nPairs, ivBins))
+        nonevent = np.zeros((nPairs, ivBins))
+        width = np.where(high > low, (high - low) / ivBins, 1.0)
+        for rows, pairSlice, values in tiles():
+            finite = np.isfinite(values)
+            scaled = (np.where(finite, values, low[pairSlice]) - low[pairSlice]) / width[pairSlice]
+            codes = np.clip(scaled.astype(np.int64), 0, ivBins - 1)
+            codes += (np.arange(values.shape[1]) * ivBins)[None, :]
+            y = np.broadcast_to(isEvent[rows][:, None], values.shape)
+            size = values.shape[1] * ivBins
+            allCounts = np.bincount(codes[finite], minlength=size).reshape(-1, ivBins)
+            eventCounts = np.bincount(codes[finite & y], minlength=size).reshape(-1, ivBins)
+            event[pairSlice] += eventCounts
+            nonevent[pairSlice] += allCounts - eventCounts
+        keep &= iv_from_counts(event, nonevent) > minIV
+    return keep
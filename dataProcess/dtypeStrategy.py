@@ -0,0 +1,252 @@
+# -*- coding: utf-8 -*-
+"""
+*********************************************************************
+*                          Funtion Table                            *
+*********************************************************************
+*     infer_schema()            *      根据样本推断每列压缩后的dtype     *
+*********************************************************************
+*     merge_schema()            *      合并多个文件推断出的schema        *
+*********************************************************************
+*     apply_schema()            *      按schema压缩dtype               *
+*********************************************************************
+*     memory_report()           *      压缩前后的内存对比               *
+*********************************************************************
+*     schema_to_json()          *      schema转为可以json保存的字典      *
+*********************************************************************
+*     schema_from_json()        *      由json读出的字典还原schema        *
+*********************************************************************
+
+schema为{列名: dtype}的字典，dtype除了pandas能识别的dtype外，还可以是：
+    'float'   : 转为float32
+    'integer' : 转为能放下的最小整数类型，有缺失时转为对应的可空整数（Int8/Int16/...），
+                有小数时退回float32；宽度由每份数据自己的取值范围决定
+    'Int8'/'Int16'/'Int32'/'Int64' : 固定宽度的整数，有缺失时为可空整数，有小数时退回float32，
+                infer_schema按样本的取值范围推断出的就是固定宽度，各月份文件的同一列得到同样的dtype；
+                个别数据超出该宽度时发出警告并加宽，不会溢出
+    CategoricalDtype : infer_schema对字符型特征推断出的类别，类别为各文件样本中出现过的取值，
+                各月份文件的同一列得到同样的类别；个别数据有类别外的取值时发出警告并加上这些类别，不会变成缺失
+    'category' : 按每份数据自己的取值转为category，各文件的类别可能不同
+apply_schema的nullable='float'时，整数列转为能精确表示的浮点数（Int8/Int16为float32，更宽的为float64），
+缺失为NaN，适合之后还要left join的数据：join补上的缺失和文件中的缺失一样都是NaN，各月份的dtype也一致。
+"""
+
+import numpy as np
+import pandas as pd
+import warnings
+
+__all__ = ['infer_schema', 'merge_schema', 'apply_schema', 'memory_report', 'schema_to_json', 'schema_from_json']
+
+# 整数类型由窄到宽，(numpy类型, 可空整数类型)
+_INTEGER_TYPES = [(np.int8, 'Int8'), (np.int16, 'Int16'), (np.int32, 'Int32'), (np.int64, 'Int64')]
+_NULLABLE_NAMES = [nullableType for _, nullableType in _INTEGER_TYPES]
+
+
+def infer_schema(X, categoryRatio=0.5, exclude=('cust_no',)):
+    """
+    根据样本数据推断每列的dtype
+
+    Parameters
+    ----------
+    X : DataFrame
+        样本数据
+    categoryRatio : Float, default 0.5
+        字符型特征不同值的个数占样本比例低于该阈值时，转为category
+    exclude : Tuple[Str]
+        不做转换的列
+
+    Returns
+    -------
+    schema : Dict
+        {列名: dtype}
+    """
+    schema = {}
+    for colName in X.columns:
+        if colName in exclude:
+            continue
+        series = X[colName]
+        if pd.api.types.is_bool_dtype(series):
+            continue
+        elif pd.api.types.is_integer_dtype(series):
+            schema[colName] = _integer_width(series.dropna())
+        elif pd.api.types.is_float_dtype(series):
+            notnull = series.dropna()
+            if notnull.size > 0 and np.all(np.mod(notnull.values, 1) == 0):
+                schema[colName] = _integer_width(notnull)
+            else:
+                schema[colName] = 'float'
+        elif pd.api.types.is_object_dtype(series) or pd.api.types.is_string_dtype(series):
+            if series.nunique() < categoryRatio * max(series.size, 1):
+                schema[colName] = pd.CategoricalDtype(_sorted_categories(series.dropna().unique()))
+    return schema
+
+
+def merge_schema(schemaList):
+    """
+    合并多个文件推断出的schema，同一列的推断结果不一致时取较宽的类型：
+    float优先于整数，固定宽度的整数取最宽的，类别取并集，其他类型不一致时不做转换
+    """
+    schema = {}
+    conflict = set()
+    for s in schemaList:
+        for colName, dtype in s.items():
+            if colName in conflict:
+                continue
+            old = schema.get(colName)
+            if old is None or old == dtype:
+                schema[colName] = dtype
+            elif isinstance(old, pd.CategoricalDtype) and isinstance(dtype, pd.CategoricalDtype):
+                schema[colName] = pd.CategoricalDtype(_sorted_categories(old.categories.union(dtype.categories)))
+            elif old in _NULLABLE_NAMES and dtype in _NULLABLE_NAMES:
+                schema[colName] = max(old, dtype, key=_NULLABLE_NAMES.index)
+            elif {old, dtype} <= set(_NULLABLE_NAMES + ['integer', 'float']) and 'float' in {old, dtype}:
+                schema[colName] = 'float'
+            elif {old, dtype} <= set(_NULLABLE_NAMES + ['integer']):
+                schema[colName] = 'integer'
+            else:
+                schema.pop(colName)
+                conflict.add(colName)
+    return schema
+
+
+def apply_schema(X, schema, nullable=False):
+    """
+    按schema转换各列的dtype，schema中没有的列保持不变
+
+    Parameters
+    ----------
+    X : DataFrame
+        数据集
+    schema : Dict
+        {列名: dtype}
+    nullable : Bool or Str, default False
+        整数列的处理方式：False为没有缺失时转为numpy整数，有缺失时转为可空整数；True为一律转为可空整数；
+        'float'为转为能精确表示的float32/float64，缺失为NaN，InputBaseData读取特征文件时使用
+
+    Returns
+    -------
+    X : DataFrame
+        转换后的数据集
+    """
+    converted = {}
+    for colName in X.columns:
+        dtype = schema.get(colName)
+        if dtype is None:
+            continue
+        series = X[colName]
+        if dtype == 'float':
+            converted[colName] = series.astype(np.float32)
+        elif dtype == 'integer':
+            converted[colName] = _downcast_integer(series, nullable)
+        elif dtype in _NULLABLE_NAMES:
+            converted[colName] = _downcast_integer(series, nullable, dtype)
+        elif isinstance(dtype, pd.CategoricalDtype):
+            converted[colName] = _to_category(series, dtype)
+        else:
+            converted[colName] = series.astype(dtype)
+    if converted:
+        X = X.copy(deep=False)
+        for colName, series in converted.items():
+            X[colName] = series
+    return X
+
+
+def memory_report(before, after):
+    """
+    压缩前后各列的内存对比
+
+    Parameters
+    ----------
+    before : DataFrame
+        压缩前的数据集
+    after : DataFrame
+        压缩后的数据集
+
+    Returns
+    -------
+    report : DataFrame
+        各列压缩前后的dtype和内存（字节），最后一行为合计
+    """
+    report = pd.DataFrame({
+        'dtype_before': before.dtypes.astype(str),
+        'dtype_after': after.dtypes.astype(str),
+        'bytes_before': before.memory_usage(index=False, deep=True),
+        'bytes_after': after.memory_usage(index=False, deep=True),
+    })
+    report.loc['total', ['bytes_before', 'bytes_after']] = report[['bytes_before', 'bytes_after']].sum()
+    report['ratio'] = report['bytes_after'] / report['bytes_before']
+    return report
+
+
+def schema_to_json(schema):
+    """
+    schema转为可以json保存的字典，CategoricalDtype保存为{'categories': [...]}
+    """
+    if schema is None:
+        return None
+    return dict((colName, {'categories': dtype.categories.tolist()} if isinstance(dtype, pd.CategoricalDtype) else dtype)
+                for colName, dtype in schema.items())
+
+
+def schema_from_json(spec):
+    """
+    由schema_to_json的结果还原schema
+    """
+    if spec is None:
+        return None
+    return dict((colName, pd.CategoricalDtype(dtype['categories']) if isinstance(dtype, dict) else dtype)
+                for colName, dtype in spec.items())
+
+
+def _sorted_categories(values):
+    values = list(values)
+    try:
+        return sorted(values)
+    except TypeError:
+        # 取值类型混杂无法排序时保持出现的顺序
+        return values
+
+
+def _to_category(series, dtype):
+    notnull = series.dropna()
+    unseen = notnull[~notnull.isin(dtype.categories)].unique()
+    if len(unseen) > 0:
+        warnings.warn(f"{series.name}有{len(unseen)}个schema中没有的类别，已加入类别")
+        dtype = pd.CategoricalDtype(_sorted_categories(dtype.categories.union(pd.Index(unseen))))
+    return series.astype(dtype)
+
+
+def _integer_width(notnull):
+    # 能放下样本取值范围的最窄的可空整数类型
+    if notnull.size == 0:
+        return 'Int8'
+    lo, hi = notnull.min(), notnull.max()
+    for npType, nullableType in _INTEGER_TYPES:
+        info = np.iinfo(npType)
+        if info.min <= lo and hi <= info.max:
+            break
+    return nullableType
+
+
+def _downcast_integer(series, nullable, width=None):
+    """
+    width为None时按取值范围选最窄的整数类型，否则固定为width，超出width的范围时加宽
+    """
+    notnull = series.dropna()
+    if notnull.size > 0 and not np.all(np.mod(notnull.values, 1) == 0):
+        # 有小数的列退回float32
+        return series.astype(np.float32)
+    fitted = _integer_width(notnull)
+    if width is None:
+        width = fitted
+    elif _NULLABLE_NAMES.index(fitted) > _NULLABLE_NAMES.index(width):
+        warnings.warn(f"{series.name}的取值超出了schema中的{width}，加宽为{fitted}")
+        width = fitted
+    npType = _INTEGER_TYPES[_NULLABLE_NAMES.index(width)][0]
+    nullableType = width
+    if nullable == 'float':
+        # float32能精确表示16位整数，更宽的用float64
+        return series.astype(np.float32 if width in ('Int8', 'Int16') else np.float64)
+    if nullable or notnull.size < series.size:
+        return series.astype(nullableType)
+    return series.astype(npType)
+
@@ -0,0 +1,193 @@
+# -*- coding: utf-8 -*-
+"""
+*********************************************************************
+*                          Funtion Table                            *
+*********************************************************************
+*     FeatureCache.get()        *      读取缓存，失效时返回None          *
+*********************************************************************
+*     FeatureCache.put()        *      按列写入缓存，并淘汰旧缓存         *
+*********************************************************************
+*     FeatureCache.read_csv()   *      带缓存的read_csv                *
+*********************************************************************
+*     FeatureCache.clear()      *      清空缓存                       *
+*********************************************************************
+
+缓存目录下每个文件一个子目录，子目录中每列一个.npy文件，外加一个meta.json，
+meta.json记录源文件的路径、大小、修改时间、内容哈希，以及各列的dtype。
+数值、布尔、日期列以copy-on-write的mmap方式（mmap_mode='c'）读取，不拷贝数据，
+修改返回的DataFrame时只复制被修改的内存页，不会写回缓存文件，和pd.read_csv一样可以直接修改；
+字符串等object列需要整列读入。
+"""
+
+import numpy as np
+import pandas as pd
+import hashlib, json, os, shutil, time, uuid
+
+__all__ = ['FeatureCache']
+
+
+class FeatureCache(object):
+    def __init__(self, cacheDir, maxBytes=None, verifyHash=False):
+        """
+        parameter:
+        ----------
+        cacheDir : Str
+            缓存文件夹
+        maxBytes : Int, default None
+            缓存总大小的上限，超出时按最近最少使用的顺序淘汰，None为不限制
+        verifyHash : Bool, default False
+            大小和修改时间都没变时，是否还要校验内容哈希
+        """
+        self.cacheDir = cacheDir
+        self.maxBytes = maxBytes
+        self.verifyHash = verifyHash
+        os.makedirs(cacheDir, exist_ok=True)
+
+    def read_csv(self, path, **kwargs):
+        """
+        带缓存的pd.read_csv，命中时直接读取缓存，否则解析后写入缓存
+        parameter:
+        ----------
+        path : Str
+            csv文件路径
+        kwargs :
+            传给pd.read_csv的参数，参数不同的缓存互不影响
+
+        return:
+        ----------
+        df : DataFrame
+            解析后的数据，命中缓存时数值列为copy-on-write的mmap，可以修改，修改不影响缓存
+        """
+        df = self.get(path, **kwargs)
+        if df is None:
+            df = pd.read_csv(path, **kwargs)
+            self.put(path, df, **kwargs)
+        return df
+
+    def get(self, path, **kwargs):
+        """
+        读取缓存，源文件的大小、修改时间变化且内容哈希也变化时，或源文件已被删除时，缓存失效并被删除
+        """
+        entryDir = self.__entryDir(path, kwargs)
+        meta = self.__loadMeta(entryDir)
+        if meta is None:
+            return None
+        try:
+            stat = os.stat(path)
+        except FileNotFoundError:
+            shutil.rmtree(entryDir, ignore_errors=True)
+            return None
+        if meta['size'] != stat.st_size:
+            shutil.rmtree(entryDir, ignore_errors=True)
+            return None
+        if meta['mtime'] != stat.st_mtime_ns or self.verifyHash:
+            if meta['hash'] != self.__fileHash(path):
+                shutil.rmtree(entryDir, ignore_errors=True)
+                return None
+            meta['mtime'] = stat.st_mtime_ns
+        meta['atime'] = time.time()
+        self.__dumpMeta(entryDir, meta)
+        columns = {}
+        for i, (colName, dtype) in enumerate(meta['columns']):
+            colPath = os.path.join(entryDir, "%d.npy" % i)
+            if dtype == 'object' or not self.__isNumpyDtype(dtype):
+                values = np.load(colPath, allow_pickle=True)
+                columns[colName] = pd.Series(values, dtype=dtype, copy=False)
+            else:
+                # copy-on-write，返回的数据可以修改，修改不会写回缓存
+                columns[colName] = np.load(colPath, mmap_mode='c')
+        df = pd.DataFrame(columns, columns=[i for i, _ in meta['columns']], copy=False)
+        return df
+
+    def put(self, path, df, **kwargs):
+        """
+        把解析好的df按列写入缓存，写入后按LRU淘汰超出上限的缓存
+        """
+        entryDir = self.__entryDir(path, kwargs)
+        tmpDir = entryDir + ".tmp" + uuid.uuid4().hex
+        os.makedirs(tmpDir)
+        stat = os.stat(path)
+        columns = []
+        for i, colName in enumerate(df.columns):
+            series = df.iloc[:, i]
+            dtype = str(series.dtype)
+            if self.__isNumpyDtype(dtype) and dtype != 'object':
+                np.save(os.path.join(tmpDir, "%d.npy" % i), series.to_numpy())
+            else:
+                np.save(os.path.join(tmpDir, "%d.npy" % i), series.to_numpy(dtype=object), allow_pickle=True)
+            columns.append((colName, dtype))
+        meta = {'path': os.path.abspath(path), 'kwargs': repr(sorted(kwargs.items())),
+                'size': stat.st_size, 'mtime': stat.st_mtime_ns, 'hash': self.__fileHash(path),
+                'columns': columns, 'atime': time.time()}
+        self.__dumpMeta(tmpDir, meta)
+        shutil.rmtree(entryDir, ignore_errors=True)
+        try:
+            os.replace(tmpDir, entryDir)
+        except OSError:
+            # 并行写入同一个缓存时，保留先写好的那份
+            shutil.rmtree(tmpDir, ignore_errors=True)
+        self.evict()
+        return
+
+    def evict(self):
+        """
+        缓存总大小超过maxBytes时，按最近访问时间从旧到新删除缓存
+        """
+        if self.maxBytes is None:
+            return
+        entries = []
+        totalBytes = 0
+        for name in os.listdir(self.cacheDir):
+            entryDir = os.path.join(self.cacheDir, name)
+            meta = self.__loadMeta(entryDir)
+            if meta is None:
+                continue
+            nbytes = sum(os.path.getsize(os.path.join(entryDir, f)) for f in os.listdir(entryDir))
+            entries.append((meta['atime'], nbytes, entryDir))
+            totalBytes += nbytes
+        for atime, nbytes, entryDir in sorted(entries):
+            if totalBytes <= self.maxBytes:
+                break
+            shutil.rmtree(entryDir, ignore_errors=True)
+            totalBytes -= nbytes
+        return
+
+    def clear(self):
+        """
+        清空缓存
+        """
+        shutil.rmtree(self.cacheDir, ignore_errors=True)
+        os.makedirs(self.cacheDir, exist_ok=True)
+        return
+
+    def __entryDir(self, path, kwargs):
+        key = os.path.abspath(path) + "|" + repr(sorted(kwargs.items()))
+        return os.path.join(self.cacheDir, hashlib.sha1(key.encode('utf-8')).hexdigest())
+
+    @staticmethod
+    def __loadMeta(entryDir):
+        try:
+            with open(os.path.join(entryDir, "meta.json"), encoding='utf-8') as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return None
+
+    @staticmethod
+    def __dumpMeta(entryDir, meta):
+        with open(os.path.join(entryDir, "meta.json"), 'w', encoding='utf-8') as f:
+            json.dump(meta, f, ensure_ascii=False)
+
+    @staticmethod
+    def __fileHash(path, blockSize=1 << 20):
+        h = hashlib.blake2b(digest_size=16)
+        with open(path, 'rb') as f:
+            for block in iter(lambda: f.read(blockSize), b''):
+                h.update(block)
+        return h.hexdigest()
+
+    @staticmethod
+    def __isNumpyDtype(dtype):
+        try:
+            return isinstance(pd.api.types.pandas_dtype(dtype), np.dtype)
+        except TypeError:
+            return False
@@ -0,0 +1,201 @@
+# -*- coding: utf-8 -*-
+"""
+*********************************************************************
+*                          Funtion Table                            *
+*********************************************************************
+*     FeaturePlan.from_yaml()   *      从yaml文件读取特征计划             *
+*********************************************************************
+*     FeaturePlan.run()         *      按计划生成全部特征                *
+*********************************************************************
+*     FeaturePlan.outputs       *      全部输出特征的名称                *
+*********************************************************************
+
+特征计划为字典（或yaml），'features'中每一项是一次DesignMethod的调用：
+    {'features': [
+        {'op': 'mathFeatures', 'args': {'colName': 'aum'}},
+        {'op': 'dateFeatures', 'name': 'open_days', 'args': {'colName': 'open_dt', 'eddt': '2021-12-31'}},
+        {'op': 'whetherFeatures', 'name': 'is_open_long', 'args': {'colName': 'open_days'}},
+        {'op': 'logratioFeatures', 'name': 'aum_m0_m1', 'args': {'colNameA': 'aum_m0', 'colNameB': 'aum_m1'}},
+        {'op': 'crossFeaturesBatch', 'args': {'pairs': [['sex', 'age_level']]}},
+    ]}
+返回Series的操作需要'name'作为输出特征名称，返回DataFrame的操作（mathFeatures、windowFeatures、crossFeaturesBatch）
+按DesignMethod的规则命名。
+参数中的特征（colName、colNameA、colNameB、colList、pairs）如果是其他操作的输出，就依赖于该操作，
+编译时按依赖关系分层，同一层的操作互不依赖，可以并行执行；
+同一个日期列、同一个格式的解析只做一次，供dateFeatures、timezoneFeatures、dayzoneFeatures共用；
+所有输出直接写入一个预先分配的二维数组，最后包装成一个DataFrame，不再逐个pd.concat。
+"""
+
+import numpy as np
+import pandas as pd
+from concurrent.futures import ThreadPoolExecutor
+from dataProcess.designFeatures import DesignMethod, _parse_dates, _window_names
+try:
+    import yaml
+except ImportError:
+    # 没有安装pyyaml时只能用字典定义特征计划
+    yaml = None
+
+__all__ = ['FeaturePlan']
+
+# 参数中表示输入特征的参数名
+_INPUT_ARGS = ['colName', 'colNameA', 'colNameB', 'colList', 'pairs']
+# 需要解析日期的操作，及日期格式的默认值
+_DATE_OPS = {'dateFeatures': '%Y-%m-%d', 'timezoneFeatures': None, 'dayzoneFeatures': None}
+
+
+class FeaturePlan(object):
+    def __init__(self, spec):
+        """
+        parameter:
+        ----------
+        spec : Dict
+            特征计划，格式见模块说明
+        """
+        self.nodes = []
+        for i, feature in enumerate(spec['features']):
+            op = feature['op']
+            if not hasattr(DesignMethod, op):
+                raise ValueError(f"第{i}项的操作{op}不是DesignMethod的方法")
+            args = dict(feature.get('args', {}))
+            if 'pairs' in args:
+                args['pairs'] = [tuple(pair) for pair in args['pairs']]
+            self.nodes.append({'op': op, 'args': args, 'inputs': _node_inputs(args),
+                               'outputs': _node_outputs(op, args, feature.get('name'))})
+        self.outputs = [name for node in self.nodes for name in node['outputs']]
+        if len(set(self.outputs)) < len(self.outputs):
+            raise ValueError("特征计划中有重复的输出特征名称")
+        self.levels = self.__compile()
+
+    @classmethod
+    def from_yaml(cls, path):
+        """
+        从yaml文件读取特征计划
+        """
+        if yaml is None:
+            raise ImportError("读取yaml需要安装pyyaml")
+        with open(path, encoding='utf-8') as f:
+            return cls(yaml.safe_load(f))
+
+    def __compile(self):
+        """
+        按依赖关系分层，每层为互不依赖的节点下标
+        """
+        producer = {}
+        for i, node in enumerate(self.nodes):
+            for name in node['outputs']:
+                producer[name] = i
+        depends = [set(producer[name] for name in node['inputs'] if name in producer) for node in self.nodes]
+        levels = []
+        done = set()
+        while len(done) < len(self.nodes):
+            level = [i for i in range(len(self.nodes)) if i not in done and depends[i] <= done]
+            if not level:
+                raise ValueError("特征计划中存在循环依赖")
+            levels.append(level)
+            done.update(level)
+        return levels
+
+    def run(self, X, n_jobs=1, dtype=np.float64):
+        """
+        按计划生成全部特征
+
+        parameter:
+        ----------
+        X : DataFrame
+            数据集
+        n_jobs : Int, default 1
+            同一层内并行的线程数
+        dtype : numpy dtype, default np.float64
+            输出数组的dtype，整数特征也存为该类型
+
+        return:
+        ----------
+        features : DataFrame
+            全部输出特征，列的顺序和计划中的顺序一致
+        """
+        block = np.empty((X.shape[0], len(self.outputs)), dtype=dtype, order='F')
+        position = dict((name, j) for j, name in enumerate(self.outputs))
+        design = DesignMethod()
+        parsed = self.__parse_dates(X, n_jobs)
+
+        def source(name):
+            # 先取已经生成的特征，再取原始数据
+            if name in position:
+                return pd.Series(block[:, position[name]], index=X.index, name=name)
+            return X[name]
+
+        def runNode(i):
+            node = self.nodes[i]
+            inputs = [name for name in node['inputs'] if name in position]
+            dateKey = _date_key(node)
+            if inputs or dateKey in parsed:
+                # 依赖其他输出或共用解析后的日期时，只把用到的列组成一个新的DataFrame
+                data = dict((name, source(name)) for name in node['inputs'])
+                if dateKey in parsed:
+                    data[dateKey[0]] = parsed[dateKey]
+                data = pd.DataFrame(data, index=X.index)
+            else:
+                data = X
+            result = getattr(design, node['op'])(data, **node['args'])
+            values = result.to_numpy() if isinstance(result, pd.Series) else result[node['outputs']].to_numpy()
+            cols = [position[name] for name in node['outputs']]
+            block[:, cols[0]:cols[-1] + 1] = values.reshape(len(X), len(cols))
+
+        for level in self.levels:
+            if n_jobs <= 1 or len(level) == 1:
+                for i in level:
+                    runNode(i)
+            else:
+                with ThreadPoolExecutor(max_workers=n_jobs) as pool:
+                    list(pool.map(runNode, level))
+        features = pd.DataFrame(block, index=X.index, columns=self.outputs, copy=False)
+        return features
+
+    def __parse_dates(self, X, n_jobs):
+        """
+        同一列同一格式被多个日期操作用到时，只解析一次
+        """
+        keys = [_date_key(node) for node in self.nodes]
+        shared = set(key for key in keys if key is not None and keys.count(key) > 1 and key[0] in X.columns)
+
+        def parse(key):
+            return key, _parse_dates(X[key[0]], key[1])
+
+        if n_jobs <= 1:
+            return dict(parse(key) for key in shared)
+        with ThreadPoolExecutor(max_workers=n_jobs) as pool:
+            return dict(pool.map(parse, shared))
+
+
+def _node_inputs(args):
+    inputs = []
+    for argName in _INPUT_ARGS:
+        value = args.get(argName)
+        if value is None:
+            continue
+        if argName == 'pairs':
+            inputs.extend(name for pair in value for name in pair)
+        elif isinstance(value, (list, tuple)):
+            inputs.extend(value)
+        else:
+            inputs.append(value)
+    return list(dict.fromkeys(inputs))
+
+
+def _node_outputs(op, args, name):
+    if op == 'mathFeatures':
+        return [args['colName'] + "_" + stat for stat in ['max', 'min', 'mean', 'std']]
+    if op == 'windowFeatures':
+        return _window_names(args['baseName'], args.get('windows', (3,)), args.get('stats'))
+    if op == 'crossFeaturesBatch':
+        return [colNameA + "_" + colNameB for colNameA, colNameB in args['pairs']]
+    if name is None:
+        raise ValueError(f"{op}需要指定输出特征名称name")
+    return [name]
+
+
+def _date_key(node):
+    if node['op'] not in _DATE_OPS:
+        return None
+    return node['args']['colName'], node['args'].get('format', _DATE_OPS[node['op']])
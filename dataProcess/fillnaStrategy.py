@@ -16,13 +16,22 @@
 *********************************************************************
 *     fillna_model()            *      模型方法填缺                   *
 *********************************************************************
+*     ModelImputer              *      K近邻、决策树填缺的拟合和应用      *
+*********************************************************************
 
 """
 
 from utils.utils import calSaturation
 import pandas  as pd
+import numpy as np
+from scipy.spatial import cKDTree
+try:
+    from sklearn.tree import DecisionTreeRegressor, DecisionTreeClassifier
+except ImportError:
+    # 没有安装sklearn时只能用K近邻填缺
+    DecisionTreeRegressor = DecisionTreeClassifier = None
 
-__all__ = ['FillnanMethod']
+__all__ = ['FillnanMethod', 'ModelImputer']
 
 
 class FillnanMethod(object):
@@ -132,11 +141,228 @@ class FillnanMethod(object):
         return Xarray, value
 
     #模型填缺策略，K近邻、决策树等
-    def fillna_model(self, X,column,model='KNN'):
+    def fillna_model(self, X, column, model='KNN', featureCols=None, k=5, imputer=None):
+        '''
+        模型填缺策略，用没有缺失的特征找相似的样本或训练决策树来填缺，
+        返回的imputer可以直接用于新数据（如打分数据）的填缺，不用重新拟合
+
+        Parameters
+        -------------------
+        X: DataFrame
+            数据集
+        column: Str or List[Str]
+            指定填缺的列，多列时同一种缺失组合的样本只查询一次近邻
+        model: Str, default 'KNN'
+            'KNN'为K近邻，'tree'为决策树（需要安装sklearn）
+        featureCols: List[Str], default None
+            用来计算相似度或训练模型的特征，None时取没有缺失的数值型特征（不含cust_no、label）
+        k: Int, default 5
+            K近邻的个数
+        imputer: ModelImputer, default None
+            已经拟合好的填缺模型，不为None时不再拟合
+
+        Return
+        -------------------
+        Xarray : Series or DataFrame
+            填缺好的数列，column为列表时是DataFrame
+        imputer : ModelImputer
+            拟合好的填缺模型
+        '''
+        columns = [column] if isinstance(column, str) else list(column)
+        if imputer is None:
+            imputer = ModelImputer(model, k).fit(X, columns, featureCols)
+        filled = imputer.transform(X)
+        Xarray = filled[column] if isinstance(column, str) else filled[columns]
+        return Xarray, imputer
+
+
+class ModelImputer(object):
+    def __init__(self, model='KNN', k=5, bruteDims=15, blockSize=4096, maxDepth=8, memoryBudget=256 * 2 ** 20):
+        '''
+        Parameters
+        -------------------
+        model: Str, default 'KNN'
+            'KNN'或'tree'
+        k: Int, default 5
+            K近邻的个数，数值型取近邻的均值，其他类型取近邻中最多的值
+        bruteDims: Int, default 15
+            特征维数超过该值时KD树效率不高，改为分块计算全部距离
+        blockSize: Int, default 4096
+            每次查询的样本数
+        maxDepth: Int, default 8
+            决策树的最大深度
+        memoryBudget: Int, default 256MB
+            分块计算距离时一块距离矩阵占用的内存上限，候选样本很多时也按块计算
         '''
-        模型填缺策略
+        if model not in ('KNN', 'tree'):
+            raise ValueError(f"model只能是'KNN'或'tree'，不能是{model}")
+        if model == 'tree' and DecisionTreeRegressor is None:
+            raise ImportError("决策树填缺需要安装sklearn")
+        self.model = model
+        self.k = k
+        self.bruteDims = bruteDims
+        self.blockSize = blockSize
+        self.maxDepth = maxDepth
+        self.memoryBudget = memoryBudget
+        self.__indexes = {}
+
+    def fit(self, X, columns, featureCols=None, exclude=('cust_no', 'label')):
+        '''
+        用X拟合填缺模型：记录特征的均值和标准差，保存标准化后的特征和需要填缺的列，
+        决策树在这里训练，K近邻的索引在第一次查询某种缺失组合时建立并缓存
+
+        Parameters
+        -------------------
+        X: DataFrame
+            训练数据
+        columns: List[Str]
+            需要填缺的列
+        featureCols: List[Str], default None
+            用来计算相似度或训练模型的特征，None时取没有缺失的数值型特征（exclude中的列除外）
+        exclude: Tuple[Str], default ('cust_no', 'label')
+            featureCols为None时不作为特征的列，默认去掉客户号和标签，避免用ID和标签填缺
         '''
-        pass
+        self.columns = list(columns)
+        if featureCols is None:
+            numeric = X.select_dtypes(include='number')
+            featureCols = [i for i in numeric.columns
+                           if i not in self.columns and i not in exclude and numeric[i].notnull().all()]
+        if not featureCols:
+            raise ValueError("没有可以用来填缺的完整特征")
+        self.featureCols = list(featureCols)
+        features = X[self.featureCols].to_numpy(dtype=np.float64, na_value=np.nan)
+        self.mean = np.nanmean(features, axis=0)
+        std = np.nanstd(features, axis=0)
+        self.std = np.where(std > 0, std, 1.0)
+        self.reference = self.__standardize(features)
+        self.targets = dict((i, _target_values(X[i])) for i in self.columns)
+        self.present = dict((i, X[i].notnull().to_numpy()) for i in self.columns)
+        self.__indexes = {}
+        self.trees = {}
+        if self.model == 'tree':
+            for i in self.columns:
+                target = self.targets[i][self.present[i]]
+                Tree = DecisionTreeRegressor if _is_numeric(target) else DecisionTreeClassifier
+                self.trees[i] = Tree(max_depth=self.maxDepth).fit(self.reference[self.present[i]], target)
+        return self
+
+    def transform(self, X):
+        '''
+        对X中需要填缺的列填缺
+
+        Return
+        -------------------
+        filled : DataFrame
+            填缺后的列
+        '''
+        missingCols = [i for i in self.columns + self.featureCols if i not in X.columns]
+        if missingCols:
+            raise KeyError(f"数据中缺少拟合时用到的列{missingCols}")
+        filled = X[self.columns].copy()
+        Z = self.__standardize(X[self.featureCols].to_numpy(dtype=np.float64, na_value=np.nan))
+        missing = filled.isnull().to_numpy()
+        rows = np.nonzero(missing.any(axis=1))[0]
+        if rows.size == 0:
+            return filled
+        if self.model == 'tree':
+            for j, colName in enumerate(self.columns):
+                idx = np.nonzero(missing[:, j])[0]
+                if idx.size:
+                    filled.iloc[idx, j] = _cast_like(self.trees[colName].predict(Z[idx]), filled.dtypes.iloc[j])
+            return filled
+        # 同一种缺失组合的样本一起查询，近邻取这些列都不缺失的样本
+        patterns, inverse = np.unique(missing[rows], axis=0, return_inverse=True)
+        inverse = inverse.ravel()
+        for p, pattern in enumerate(patterns):
+            idx = rows[inverse == p]
+            colIdx = np.nonzero(pattern)[0]
+            donors, neighbors = self.__query(tuple(colIdx), Z[idx])
+            for j in colIdx:
+                values = self.targets[self.columns[j]][donors][neighbors]
+                filled.iloc[idx, j] = _cast_like(_neighbor_value(values), filled.dtypes.iloc[j])
+        return filled
+
+    def __standardize(self, features):
+        Z = (features - self.mean) / self.std
+        # 新数据中特征的缺失按均值处理
+        Z[np.isnan(Z)] = 0
+        return Z
+
+    def __query(self, colIdx, Q):
+        '''
+        在colIdx这些列都不缺失的样本中查询Q的k个近邻，返回(候选样本下标, 近邻在候选样本中的下标)
+        '''
+        if colIdx not in self.__indexes:
+            mask = np.logical_and.reduce([self.present[self.columns[j]] for j in colIdx])
+            donors = np.nonzero(mask)[0]
+            if donors.size == 0:
+                raise ValueError(f"{[self.columns[j] for j in colIdx]}没有同时不缺失的样本，无法用K近邻填缺")
+            tree = cKDTree(self.reference[donors]) if self.reference.shape[1] <= self.bruteDims else None
+            self.__indexes[colIdx] = (donors, tree)
+        donors, tree = self.__indexes[colIdx]
+        k = min(self.k, donors.size)
+        neighbors = np.empty((Q.shape[0], k), dtype=np.int64)
+        for start in range(0, Q.shape[0], self.blockSize):
+            block = Q[start:start + self.blockSize]
+            if tree is not None:
+                _, idx = tree.query(block, k=k)
+                neighbors[start:start + len(block)] = idx.reshape(len(block), k)
+            else:
+                neighbors[start:start + len(block)] = self.__brute_neighbors(donors, block, k)
+        return donors, neighbors
+
+    def __brute_neighbors(self, donors, block, k):
+        '''
+        维数高时按候选样本分块计算距离，每块和当前的k个近邻合并后用argpartition保留最近的k个，
+        一块距离矩阵的内存不超过memoryBudget，|q-r|^2 = |q|^2 - 2q·r + |r|^2，|q|^2不影响排序
+        '''
+        step = max(k, self.memoryBudget // (8 * len(block)))
+        bestDist = np.full((len(block), k), np.inf)
+        bestIdx = np.zeros((len(block), k), dtype=np.int64)
+        for start in range(0, donors.size, step):
+            reference = self.reference[donors[start:start + step]]
+            dist = (reference ** 2).sum(axis=1)[None, :] - 2 * block @ reference.T
+            allDist = np.concatenate([bestDist, dist], axis=1)
+            allIdx = np.concatenate([bestIdx, np.broadcast_to(np.arange(start, start + len(reference)), dist.shape)], axis=1)
+            keep = np.argpartition(allDist, k - 1, axis=1)[:, :k]
+            bestDist = np.take_along_axis(allDist, keep, axis=1)
+            bestIdx = np.take_along_axis(allIdx, keep, axis=1)
+        return bestIdx
+
+
+def _target_values(series):
+    '''
+    需要填缺的列转为数组，数值型（包括nullable整数）统一为float64，缺失为NaN
+    '''
+    if pd.api.types.is_numeric_dtype(series.dtype) and not pd.api.types.is_bool_dtype(series.dtype):
+        return series.to_numpy(dtype=np.float64, na_value=np.nan)
+    return series.to_numpy()
+
+
+def _cast_like(values, dtype):
+    '''
+    填缺值转为原列的类型，整数列（如dtypeSchema生成的Int8、Int16）四舍五入后转换，避免写入时报错
+    '''
+    if pd.api.types.is_integer_dtype(dtype) and _is_numeric(values):
+        return np.round(values).astype(np.int64)
+    return values
+
+
+def _is_numeric(values):
+    return np.asarray(values).dtype.kind in 'biuf'
+
+
+def _neighbor_value(values):
+    '''
+    近邻的取值，values每行为一个样本的k个近邻，数值型取均值，其他类型取最多的值
+    '''
+    if _is_numeric(values):
+        return values.astype(np.float64).mean(axis=1)
+    codes, uniques = pd.factorize(values.ravel())
+    codes = codes.reshape(values.shape)
+    counts = np.zeros((values.shape[0], len(uniques)), dtype=np.int64)
+    np.add.at(counts, (np.repeat(np.arange(values.shape[0]), values.shape[1]), codes.ravel()), 1)
+    return uniques[counts.argmax(axis=1)]
 
 
 
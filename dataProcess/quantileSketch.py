@@ -0,0 +1,133 @@
+# -*- coding: utf-8 -*-
+"""
+*********************************************************************
+*                          Funtion Table                            *
+*********************************************************************
+*     QuantileSketch.update()   *      加入一批数据                    *
+*********************************************************************
+*     QuantileSketch.merge()    *      合并另一个sketch               *
+*********************************************************************
+*     QuantileSketch.quantiles()*      求近似分位数                    *
+*********************************************************************
+*     QuantileSketch.rank_error()*     分位数秩误差的上界               *
+*********************************************************************
+
+可合并的分位数sketch（KLL/MRL式的压缩器）：
+第h层的每个元素代表2^h个样本，某一层的元素个数达到k时，排序后隔一个取一个升到上一层。
+一次压缩对任意取值的秩带来的误差不超过该层的权重2^h，sketch累计记录这些误差，
+rank_error()返回的就是秩误差占样本数比例的上界：
+    |近似秩 - 真实秩| <= rank_error() * n
+每层最多压缩n/(k*2^h)次，所以上界不超过(层数/k)，约为log2(n/k)/k，
+例如k=2000、n=1e8时约为0.8%。
+"""
+
+import numpy as np
+
+__all__ = ['QuantileSketch']
+
+
+class QuantileSketch(object):
+    def __init__(self, k=2000):
+        """
+        parameter:
+        ----------
+        k : Int, default 2000
+            每层的容量，越大越精确，内存约为k*层数
+        """
+        self.k = k
+        self.levels = []
+        self.n = 0
+        self.errorWeight = 0
+        self.minValue = np.inf
+        self.maxValue = -np.inf
+        self.__offsets = []
+
+    def update(self, values):
+        """
+        加入一批数据，缺失值会被忽略
+        """
+        values = np.asarray(values, dtype=np.float64).ravel()
+        values = values[~np.isnan(values)]
+        if values.size == 0:
+            return self
+        self.n += values.size
+        self.minValue = min(self.minValue, values.min())
+        self.maxValue = max(self.maxValue, values.max())
+        self.__append(0, values)
+        self.__compress()
+        return self
+
+    def merge(self, other):
+        """
+        合并另一个sketch，合并后的误差上界为两者之和再加上新的压缩误差
+        """
+        self.n += other.n
+        self.errorWeight += other.errorWeight
+        self.minValue = min(self.minValue, other.minValue)
+        self.maxValue = max(self.maxValue, other.maxValue)
+        for h, items in enumerate(other.levels):
+            self.__append(h, items)
+        self.__compress()
+        return self
+
+    def quantiles(self, qs):
+        """
+        近似分位数，0和1分位数为精确的最小值和最大值
+
+        parameter:
+        ----------
+        qs : 1D array-like
+            0~1之间的分位点
+
+        return:
+        ----------
+        values : 1D array
+            各分位点对应的值
+        """
+        qs = np.asarray(qs, dtype=np.float64)
+        if self.n == 0:
+            return np.full(qs.shape, np.nan)
+        items = np.concatenate(self.levels)
+        weights = np.concatenate([np.full(len(level), 2 ** h, dtype=np.float64) for h, level in enumerate(self.levels)])
+        order = np.argsort(items, kind='mergesort')
+        items, cumWeights = items[order], np.cumsum(weights[order])
+        # 和np.quantile的线性插值一致：秩为q*(n-1)，在相邻两个秩对应的值之间插值，
+        # 数据量小于k没有压缩时结果和pd.qcut的切分点相同
+        ranks = qs * (cumWeights[-1] - 1)
+        lower = np.floor(ranks)
+        loIdx = np.clip(np.searchsorted(cumWeights, lower, side='right'), 0, len(items) - 1)
+        hiIdx = np.clip(np.searchsorted(cumWeights, lower + 1, side='right'), 0, len(items) - 1)
+        values = items[loIdx] + (items[hiIdx] - items[loIdx]) * (ranks - lower)
+        values = np.where(qs <= 0, self.minValue, values)
+        values = np.where(qs >= 1, self.maxValue, values)
+        return values
+
+    def rank_error(self):
+        """
+        秩误差占样本数比例的上界
+        """
+        return self.errorWeight / self.n if self.n else 0.0
+
+    def __append(self, h, items):
+        while len(self.levels) <= h:
+            self.levels.append(np.empty(0, dtype=np.float64))
+            self.__offsets.append(0)
+        self.levels[h] = np.concatenate([self.levels[h], items])
+
+    def __compress(self):
+        h = 0
+        while h < len(self.levels):
+            items = self.levels[h]
+            if len(items) >= self.k:
+                items = np.sort(items)
+                # 个数为奇数时最大的一个留在本层
+                keep = items[-1:] if len(items) % 2 else items[:0]
+                pairs = items[:len(items) - len(keep)]
+                # 交替取奇数位、偶数位，误差不会朝一个方向累积
+                promoted = pairs[self.__offsets[h]::2]
+                self.__offsets[h] ^= 1
+                self.levels[h] = keep
+                self.errorWeight += 2 ** h
+                self.__append(h + 1, promoted)
+            h += 1
+        return
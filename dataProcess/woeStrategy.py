@@ -0,0 +1,201 @@
+# -*- coding: utf-8 -*-
+"""
+*********************************************************************
+*                          Funtion Table                            *
+*********************************************************************
+*     bin_counts()              *      各特征各箱的正负样本数            *
+*********************************************************************
+*     merge_bin_counts()        *      合并分块统计的计数               *
+*********************************************************************
+*     woe_iv()                  *      由计数求每箱的WOE和每个特征的IV    *
+*********************************************************************
+*     woe_transform()           *      分箱值替换为WOE                 *
+*********************************************************************
+*     woe_iv_batch()            *      一次完成计数、WOE、IV和WOE编码     *
+*********************************************************************
+*     iv_from_counts()          *      由二维的正负样本计数矩阵求IV       *
+*********************************************************************
+
+计数表为长表，每行是一个特征的一个箱子，列为['feature', 'bin', 'event', 'nonevent']，
+event为标签等于1的样本数，nonevent为其余样本数。
+所有特征的计数只统计一次：各列分箱值factorize成整数编码后，加上各列的偏移量拼成一个编码，
+用一次bincount同时得到所有特征所有箱子的计数。
+分块读取的数据可以对每块分别调用bin_counts，再用merge_bin_counts合并后求WOE和IV。
+    WOE_i = ln((event_i + smooth) / (E + smooth) / ((nonevent_i + smooth) / (N + smooth)))
+    IV = sum((event_i / E - nonevent_i / N) * WOE_i)
+"""
+
+import numpy as np
+import pandas as pd
+
+__all__ = ['bin_counts', 'merge_bin_counts', 'woe_iv', 'woe_transform', 'woe_iv_batch', 'iv_from_counts']
+
+
+def bin_counts(X_box, label, features=None):
+    """
+    各特征各箱的正负样本数
+
+    Parameters
+    ----------
+    X_box : DataFrame
+        分箱后的数据
+    label : 1D array-like
+        标签，1为正样本
+    features : List[Str], default None
+        需要统计的特征，None为X_box的全部列
+
+    Returns
+    -------
+    counts : DataFrame
+        计数长表，列为['feature', 'bin', 'event', 'nonevent']
+    """
+    features = list(X_box.columns) if features is None else list(features)
+    nRows = X_box.shape[0]
+    codes = np.empty((nRows, len(features)), dtype=np.int64)
+    uniquesList = []
+    offsets = np.zeros(len(features), dtype=np.int64)
+    total = 0
+    for j, colName in enumerate(features):
+        # 缺失也作为一个箱子
+        colCodes, uniques = pd.factorize(X_box[colName], sort=True, use_na_sentinel=False)
+        codes[:, j] = colCodes
+        uniquesList.append(uniques)
+        offsets[j] = total
+        total += len(uniques)
+    codes += offsets
+    event = (np.asarray(label) == 1).astype(np.float64)
+    codes = codes.ravel()
+    nTotal = np.bincount(codes, minlength=total)
+    nEvent = np.bincount(codes, weights=np.repeat(event, len(features)), minlength=total).astype(np.int64)
+    bins = np.empty(total, dtype=object)
+    for j, uniques in enumerate(uniquesList):
+        bins[offsets[j]:offsets[j] + len(uniques)] = list(uniques)
+    counts = pd.DataFrame({
+        'feature': np.repeat(features, [len(uniques) for uniques in uniquesList]),
+        'bin': bins,
+        'event': nEvent,
+        'nonevent': nTotal - nEvent,
+    })
+    return counts
+
+
+def merge_bin_counts(countsList):
+    """
+    合并多个数据块的计数长表，同一特征同一箱子的计数相加
+    """
+    counts = pd.concat(countsList, ignore_index=True)
+    counts = counts.groupby(['feature', 'bin'], sort=False, dropna=False)[['event', 'nonevent']].sum().reset_index()
+    return counts
+
+
+def woe_iv(counts, smooth=0.5):
+    """
+    由计数长表求每箱的WOE和每个特征的IV
+
+    Parameters
+    ----------
+    counts : DataFrame
+        bin_counts或merge_bin_counts返回的计数长表
+    smooth : Float, default 0.5
+        平滑项，避免箱子里只有正样本或负样本时WOE为无穷
+
+    Returns
+    -------
+    woeTable : DataFrame
+        计数长表加上'woe'和每箱对IV的贡献'iv'
+    iv : Series
+        每个特征的IV，按从大到小排列
+    """
+    woeTable = counts.copy()
+    feature = woeTable['feature'].to_numpy()
+    event = woeTable['event'].to_numpy(dtype=np.float64)
+    nonevent = woeTable['nonevent'].to_numpy(dtype=np.float64)
+    # 每个特征的正负样本总数，按特征的编码用bincount求和再展开回每一行
+    featureCodes, features = pd.factorize(feature)
+    eventTotal = np.bincount(featureCodes, weights=event)[featureCodes]
+    noneventTotal = np.bincount(featureCodes, weights=nonevent)[featureCodes]
+    eventRate = (event + smooth) / (eventTotal + smooth)
+    noneventRate = (nonevent + smooth) / (noneventTotal + smooth)
+    woeTable['woe'] = np.log(eventRate / noneventRate)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        woeTable['iv'] = (event / eventTotal - nonevent / noneventTotal) * woeTable['woe'].to_numpy()
+    iv = pd.Series(np.bincount(featureCodes, weights=np.nan_to_num(woeTable['iv'].to_numpy())),
+                   index=features, name='iv').sort_values(ascending=False)
+    return woeTable, iv
+
+
+def woe_transform(X_box, woeTable, fill=0.0):
+    """
+    分箱值替换为WOE
+
+    Parameters
+    ----------
+    X_box : DataFrame
+        分箱后的数据
+    woeTable : DataFrame
+        woe_iv返回的WOE表
+    fill : Float, default 0.0
+        WOE表中没有的箱子（如训练时没有出现的值）的WOE
+
+    Returns
+    -------
+    X_woe : DataFrame
+        WOE编码后的数据，只包含WOE表中的特征
+    """
+    columns = {}
+    for colName, group in woeTable.groupby('feature', sort=False):
+        if colName not in X_box.columns:
+            continue
+        idx = pd.Index(group['bin'].to_numpy()).get_indexer(X_box[colName].to_numpy())
+        woe = np.append(group['woe'].to_numpy(dtype=np.float64), [fill])
+        # get_indexer找不到时为-1，正好取到最后的fill
+        columns[colName] = woe[idx]
+    X_woe = pd.DataFrame(columns, index=X_box.index)
+    return X_woe
+
+
+def woe_iv_batch(X_box, label, features=None, smooth=0.5):
+    """
+    一次完成计数、WOE、IV和WOE编码
+
+    Returns
+    -------
+    woeTable : DataFrame
+        每箱的计数、WOE和IV贡献
+    iv : Series
+        每个特征的IV
+    X_woe : DataFrame
+        WOE编码后的数据
+    """
+    counts = bin_counts(X_box, label, features)
+    woeTable, iv = woe_iv(counts, smooth)
+    X_woe = woe_transform(X_box, woeTable)
+    return woeTable, iv, X_woe
+
+
+def iv_from_counts(event, nonevent, smooth=0.5):
+    """
+    由计数矩阵直接求IV，每行为一个特征，每列为一个箱子，适合特征很多、箱子个数相同的情况
+
+    Parameters
+    ----------
+    event : 2D array
+        各特征各箱的正样本数
+    nonevent : 2D array
+        各特征各箱的负样本数
+    smooth : Float, default 0.5
+        平滑项，和woe_iv一致
+
+    Returns
+    -------
+    iv : 1D array
+        每个特征的IV
+    """
+    event = np.asarray(event, dtype=np.float64)
+    nonevent = np.asarray(nonevent, dtype=np.float64)
+    eventAll = event.sum(axis=1, keepdims=True)
+    noneventAll = nonevent.sum(axis=1, keepdims=True)
+    woe = np.log((event + smooth) / (eventAll + smooth) / ((nonevent + smooth) / (noneventAll + smooth)))
+    with np.errstate(invalid='ignore', divide='ignore'):
+        iv = np.nan_to_num((event / eventAll - nonevent / noneventAll) * woe).sum(axis=1)
+    return iv